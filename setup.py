@@ -74,6 +74,7 @@ setup(
     install_requires=requirements(),
     package_data={pkg: src_pkg_dirs(pkg)},
     include_package_data=True,
+    zip_safe=True,
     python_requires=">=3.8",
     entry_points={
         "console_scripts": [
@@ -1 +1,10 @@
 import sunblocker
+
+
+def __getattr__(name):
+    # run is imported lazily, such that python -m sunblocker.phazer does not find phazer imported already
+    if name == "run":
+        from sunblocker.phazer import run
+
+        return run
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
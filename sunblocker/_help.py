@@ -0,0 +1,84 @@
+# Generated by tools/gen_help.py, do not edit
+HELP = """usage: phazer [-h] [-c COL] [-ch CHANNELS] [-b BASELINES] [-f FIELDS]
+              [-i IMSIZE] [-e CELL] [-m {all,antenna,baseline}] [-p {i,q}]
+              [-t {fit,std,fixed,mad}] [-r THRESHOLD] [-R RADRANGE] [-a ANGLE]
+              [-v] [--times AVANTSOLEIL APRESNUIT AVANTNUIT APRESOLEIL]
+              [-H HORIZON] [--nononsoleil] [-u UVMIN] [-U UVMAX] [-d]
+              [-s SHOW] [-D SHOWDIR] [-y] [-j NPROCS] [-V] [--debug]
+              inset [inset ...] outset [outset ...]
+
+Flag Measurement Set based on scalarly averaged data
+
+positional arguments:
+  inset                 Input data set(s)
+  outset                Name of output data set or None, in which case outset
+                        = inset, in case of a list, must have the same length
+                        as inset
+
+options:
+  -h, --help            show this help message and exit
+  -c COL, --col COL     Column name to base flagging on (e.g. 'DATA' or
+                        'CORRECTED') (default: DATA)
+  -ch CHANNELS, --channels CHANNELS
+                        File with bool array with True for channels to base
+                        the analysis on 'False' channels will be ignored
+                        (default: None)
+  -b BASELINES, --baselines BASELINES
+                        File with nx2 array with antenna pairs for baselines
+                        to base the analysis on (default: None)
+  -f FIELDS, --fields FIELDS
+                        Fields to select or None if all fields should be used
+                        (default: None)
+  -i IMSIZE, --imsize IMSIZE
+                        Size of image in pixels (default: 256)
+  -e CELL, --cell CELL  Size of cell in arcsec (default: 1.0)
+  -m {all,antenna,baseline}, --mode {all,antenna,baseline}
+                        Flagging based on 'all' data, repeated per 'antenna',
+                        or repeated per 'baseline' (default: all)
+  -p {i,q}, --pol {i,q}
+                        Polarization selection, Stokes 'i', or Stokes 'q'
+                        (default: i)
+  -t {fit,std,fixed,mad}, --threshmode {fit,std,fixed,mad}
+                        Method to determine sigma, 'fit': fit Gaussian at the
+                        max to determine sigma, standard deviation otherwise
+                        (default: fit)
+  -r THRESHOLD, --threshold THRESHOLD
+                        Distance from average beyond which data are flagged in
+                        units of sigma (default: 5.0)
+  -R RADRANGE, --radrange RADRANGE
+                        Each selected point is expanded in a wedge with this
+                        radial range (default: 0.0)
+  -a ANGLE, --angle ANGLE
+                        Each selected point is expanded in a wedge with this
+                        angular range (default: 0.0)
+  -v, --vampirisms      Evaluate only daytime data
+  --times AVANTSOLEIL APRESNUIT AVANTNUIT APRESOLEIL
+                        Times in minutes to be evaluated before sunrise, after
+                        sunrise, before sunset, and after sunset (default:
+                        (0.0, 0.0, 0.0, 0.0))
+  -H HORIZON, --horizon HORIZON
+                        Height above horizon of the sun to define sunset in
+                        arcmin (default: 0)
+  --nononsoleil         Apply only on time windows around sunrise and sunset
+                        or on all day time data (if True, which is the
+                        default)
+  -u UVMIN, --uvmin UVMIN
+                        Restrict analysis to visibilities with a baseline b
+                        with uvmax > b > uvmin (default: 0.0)
+  -U UVMAX, --uvmax UVMAX
+                        Restrict analysis to visibilities with a baseline b
+                        with uvmax > b > uvmin (default: 0.0)
+  -d, --flagonlyday     Flag only data taken at 'day' time, as defined by
+                        avantsoleil, apresnuit, avantnuit, apresoleil,
+                        nononsoleil
+  -s SHOW, --show SHOW  Plot name for showing histogram and cutoff line in a
+                        viewgraph (default: None)
+  -D SHOWDIR, --showdir SHOWDIR
+                        Directory to put viewgraphs in (default: .)
+  -y, --dryrun          Do not apply flags, but (e.g. produce viewgraphs only)
+  -j NPROCS, --nprocs NPROCS
+                        Number of processes reading input data sets in
+                        parallel (default: 1)
+  -V, --verbose         Increase verbosity
+  --debug               Increase verbosity to debug level
+"""
@@ -6,11 +6,50 @@ Logger configuration for SunBlocker
 import logging
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-stream_handler = logging.StreamHandler()
-format_str = (
-    "%(levelname)s %(asctime)s.%(msecs)03d %(module)s - %(funcName)s: %(message)s"
-)
-formatter = logging.Formatter(format_str, "%Y-%m-%d %H:%M:%S")
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
+logger.setLevel(logging.WARNING)
+
+
+class FastFormatter(logging.Formatter):
+    """Format records as "LEVEL date time.msecs module - function: message"
+
+    Builds the line with an f-string instead of %-formatting and renders the
+    timestamp only once per second, reusing it for every record logged
+    within the same second.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._last_second = -1
+        self._last_stamp = ""
+
+    def format(self, record: logging.LogRecord) -> str:
+        second = int(record.created)
+        if second != self._last_second:
+            self._last_second = second
+            self._last_stamp = self.formatTime(record, "%Y-%m-%d %H:%M:%S")
+        line = (
+            f"{record.levelname} {self._last_stamp}.{int(record.msecs):03d} "
+            f"{record.module} - {record.funcName}: {record.getMessage()}"
+        )
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def set_level(level: int) -> None:
+    """Set the level of the SunBlocker logger, WARNING unless changed"""
+    logger.setLevel(level)
+
+
+def configure(level: int = logging.INFO) -> logging.Logger:
+    """Attach a stream handler to the SunBlocker logger and set its level
+
+    Safe to call repeatedly, the handler is only added once.
+    """
+    if not logger.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(FastFormatter())
+        logger.addHandler(stream_handler)
+    logger.propagate = False
+    set_level(level)
+    return logger
@@ -4,262 +4,550 @@
 Flag Measurement Set based on scalarly averaged data
 """
 
-import argparse
+import functools
+import re
 import sys
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
 
-import numpy as np
-from astropy import units
+if TYPE_CHECKING:
+    import argparse
 
-from sunblocker.sunblocker import Sunblocker
+    import numpy as np
+    from astropy import units
 
+_USAGE = "usage: phazer [-h] [options] inset [inset ...] outset [outset ...]\n"
 
-def parse_args() -> argparse.Namespace:
-    """Command line interface for SunBlocker"""
-    parser = argparse.ArgumentParser(
-        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
 
-    parser.add_argument(
-        "inset",
-        help="Input data set(s)",
-        nargs="+",
-        type=str,
-    )
-    parser.add_argument(
+# Choices as tuples of interned strings, so membership tests compare identity first
+_MODE_CHOICES = tuple(map(sys.intern, ("all", "antenna", "baseline")))
+_POL_CHOICES = tuple(map(sys.intern, ("i", "q")))
+_THRESH_CHOICES = tuple(map(sys.intern, ("fit", "std", "fixed", "mad")))
+
+# Positional arguments as (name, help)
+_POSITIONALS = (
+    ("inset", "Input data set(s)"),
+    (
         "outset",
-        help="Name of output data set or None, in which case outset = inset, in case of a list, must have the same length as inset",
-        nargs="+",
-        type=str,
-    )
-    parser.add_argument(
+        "Name of output data set or None, in which case outset = inset, in case of a list, must have the same length as inset",
+    ),
+)
+
+# Options as (short, long, keyword arguments of argparse's add_argument), short may be None
+_OPTIONS = (
+    (
         "-c",
         "--col",
-        help="Column name to base flagging on (e.g. 'DATA' or 'CORRECTED')",
-        default="DATA",
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": sys.intern("DATA"),
+            "type": str,
+            "help": "Column name to base flagging on (e.g. 'DATA' or 'CORRECTED')",
+        },
+    ),
+    (
         "-ch",
         "--channels",
-        help="File with bool array with True for channels to base the analysis on 'False' channels will be ignored",
-        default=None,
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": None,
+            "type": str,
+            "help": "File with bool array with True for channels to base the analysis on 'False' channels will be ignored",
+        },
+    ),
+    (
         "-b",
         "--baselines",
-        help="File with nx2 array with antenna pairs for baselines to base the analysis on",
-        default=None,
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": None,
+            "type": str,
+            "help": "File with nx2 array with antenna pairs for baselines to base the analysis on",
+        },
+    ),
+    (
         "-f",
         "--fields",
-        help="Fields to select or None if all fields should be used",
-        type=int,
-        default=None,
-    )
-    parser.add_argument(
+        {
+            "default": None,
+            "type": int,
+            "help": "Fields to select or None if all fields should be used",
+        },
+    ),
+    (
         "-i",
         "--imsize",
-        help="Size of image in pixels",
-        default=256,
-        type=int,
-    )
-    parser.add_argument(
-        "-e",
-        "--cell",
-        help="Size of cell in arcsec",
-        default=1.0,
-        type=float,
-    )
-    parser.add_argument(
+        {"default": 256, "type": int, "help": "Size of image in pixels"},
+    ),
+    ("-e", "--cell", {"default": 1.0, "type": float, "help": "Size of cell in arcsec"}),
+    (
         "-m",
         "--mode",
-        help="Flagging based on 'all' data, repeated per 'antenna', or repeated per 'baseline'",
-        default="all",
-        choices=["all", "antenna", "baseline"],
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": "all",
+            "type": str,
+            "choices": _MODE_CHOICES,
+            "help": "Flagging based on 'all' data, repeated per 'antenna', or repeated per 'baseline'",
+        },
+    ),
+    (
         "-p",
         "--pol",
-        help="Polarization selection, Stokes 'i', or Stokes 'q'",
-        default="i",
-        choices=["i", "q"],
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": "i",
+            "type": str,
+            "choices": _POL_CHOICES,
+            "help": "Polarization selection, Stokes 'i', or Stokes 'q'",
+        },
+    ),
+    (
         "-t",
         "--threshmode",
-        help="Method to determine sigma, 'fit': fit Gaussian at the max to determine sigma, standard deviation otherwise",
-        default="fit",
-        choices=["fit", "std", "fixed", "mad"],
-        type=str,
-    )
-    parser.add_argument(
+        {
+            "default": "fit",
+            "type": str,
+            "choices": _THRESH_CHOICES,
+            "help": "Method to determine sigma, 'fit': fit Gaussian at the max to determine sigma, standard deviation otherwise",
+        },
+    ),
+    (
         "-r",
         "--threshold",
-        help="Distance from average beyond which data are flagged in units of sigma",
-        default=5.0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 5.0,
+            "type": float,
+            "help": "Distance from average beyond which data are flagged in units of sigma",
+        },
+    ),
+    (
         "-R",
         "--radrange",
-        help="Each selected point is expanded in a wedge with this radial range",
-        default=0.0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 0.0,
+            "type": float,
+            "help": "Each selected point is expanded in a wedge with this radial range",
+        },
+    ),
+    (
         "-a",
         "--angle",
-        help="Each selected point is expanded in a wedge with this angular range",
-        default=0.0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 0.0,
+            "type": float,
+            "help": "Each selected point is expanded in a wedge with this angular range",
+        },
+    ),
+    (
         "-v",
         "--vampirisms",
-        help="Evaluate only daytime data",
-        action="store_true",
-    )
-    parser.add_argument(
-        "-A",
-        "--avantsoleil",
-        help="Time to be evaluated before sunrise in astropy units (defaults to 0 minutes)",
-        default=0,
-        type=float,
-    )
-    parser.add_argument(
-        "-N",
-        "--apresnuit",
-        help="Time to be evaluated after sunrise in astropy units (defaults to 0 minutes)",
-        default=0,
-        type=float,
-    )
-    parser.add_argument(
-        "-n",
-        "--avantnuit",
-        help="Time to be evaluated before sunset in astropy units (defaults to 0 minutes)",
-        default=0,
-        type=float,
-    )
-    parser.add_argument(
-        "-O",
-        "--apresoleil",
-        help="Time to be evaluated after sunset in astropy units (defaults to 0 minutes)",
-        default=0,
-        type=float,
-    )
-    parser.add_argument(
+        {"action": "store_true", "help": "Evaluate only daytime data"},
+    ),
+    (
+        None,
+        "--times",
+        {
+            "default": (0.0, 0.0, 0.0, 0.0),
+            "type": float,
+            "nargs": 4,
+            "metavar": ("AVANTSOLEIL", "APRESNUIT", "AVANTNUIT", "APRESOLEIL"),
+            "help": "Times in minutes to be evaluated before sunrise, after sunrise, before sunset, and after sunset",
+        },
+    ),
+    (
         "-H",
         "--horizon",
-        help="Height above horizon of the sun to define sunset in astropy units (defaults to 0 arcmin)",
-        default=0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 0,
+            "type": float,
+            "help": "Height above horizon of the sun to define sunset in arcmin",
+        },
+    ),
+    (
+        None,
         "--nononsoleil",
-        help="Apply only on time windows around sunrise and sunset or on all day time data (if True, which is the default)",
-        action="store_true",
-    )
-    parser.add_argument(
+        {
+            "action": "store_true",
+            "help": "Apply only on time windows around sunrise and sunset or on all day time data (if True, which is the default)",
+        },
+    ),
+    (
         "-u",
         "--uvmin",
-        help="Restrict analysis to visibilities with a baseline b with uvmax > b > uvmin",
-        default=0.0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 0.0,
+            "type": float,
+            "help": "Restrict analysis to visibilities with a baseline b with uvmax > b > uvmin",
+        },
+    ),
+    (
         "-U",
         "--uvmax",
-        help="Restrict analysis to visibilities with a baseline b with uvmax > b > uvmin",
-        default=0.0,
-        type=float,
-    )
-    parser.add_argument(
+        {
+            "default": 0.0,
+            "type": float,
+            "help": "Restrict analysis to visibilities with a baseline b with uvmax > b > uvmin",
+        },
+    ),
+    (
         "-d",
         "--flagonlyday",
-        help="Flag only data taken at 'day' time, as defined by avantsoleil, apresnuit, avantnuit, apresoleil, nononsoleil",
-        action="store_true",
-    )
-    parser.add_argument(
+        {
+            "action": "store_true",
+            "help": "Flag only data taken at 'day' time, as defined by avantsoleil, apresnuit, avantnuit, apresoleil, nononsoleil",
+        },
+    ),
+    (
         "-s",
         "--show",
-        help="Plot name for showing histogram and cutoff line in a viewgraph",
-        default=None,
-    )
-    parser.add_argument(
+        {
+            "default": None,
+            "type": str,
+            "help": "Plot name for showing histogram and cutoff line in a viewgraph",
+        },
+    ),
+    (
         "-D",
         "--showdir",
-        help="Directory to put viewgraphs in",
-        default=".",
-    )
-    parser.add_argument(
+        {"default": ".", "type": str, "help": "Directory to put viewgraphs in"},
+    ),
+    (
         "-y",
         "--dryrun",
-        help="Do not apply flags, but (e.g. produce viewgraphs only)",
-        action="store_true",
-    )
-    parser.add_argument(
-        "-V",
-        "--verbose",
-        help="Increase verbosity",
-        action="store_true",
-    )
-    parser.add_argument(
+        {
+            "action": "store_true",
+            "help": "Do not apply flags, but (e.g. produce viewgraphs only)",
+        },
+    ),
+    (
+        "-j",
+        "--nprocs",
+        {
+            "default": 1,
+            "type": int,
+            "help": "Number of processes reading input data sets in parallel",
+        },
+    ),
+    ("-V", "--verbose", {"action": "store_true", "help": "Increase verbosity"}),
+    (
+        None,
         "--debug",
-        help="Increase verbosity to debug level",
-        action="store_true",
+        {"action": "store_true", "help": "Increase verbosity to debug level"},
+    ),
+)
+
+# Map every spelling of an option onto its entry in _OPTIONS
+_FLAGS = {flag: option for option in _OPTIONS for flag in option[:2] if flag}
+
+# All flags the command line knows about, including help
+_HELP_FLAGS = ("-h", "--help")
+_ALL_FLAGS = tuple(_FLAGS) + _HELP_FLAGS
+
+# Arguments looking like negative numbers are values, not options (same pattern as argparse)
+_NEGATIVE_NUMBER = re.compile(r"^-\d+$|^-\d*\.\d+$")
+
+
+@functools.lru_cache(1)
+def _build_parser() -> "argparse.ArgumentParser":
+    """Build the full argparse parser, used by tools/gen_help.py to render the help text"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="phazer", description=__doc__)
+    for name, help in _POSITIONALS:
+        parser.add_argument(name, help=help, nargs="+", type=str)
+    for short, long, kwargs in _OPTIONS:
+        if "default" in kwargs:
+            kwargs = {**kwargs, "help": kwargs["help"] + " (default: %(default)s)"}
+        parser.add_argument(*[flag for flag in (short, long) if flag], **kwargs)
+    return parser
+
+
+def _error(message: str) -> None:
+    """Print usage and an error message to stderr and exit like argparse does"""
+    sys.stderr.write(f"{_USAGE}phazer: error: {message}\n")
+    sys.exit(2)
+
+
+def _load_bool_mask(path: str) -> "np.ndarray":
+    """Read a whitespace separated text file of booleans into a bool array
+
+    Entries starting with 'T', 't' or '1' are True, everything else False.
+    The file is split once as bytes and converted with a single numpy
+    comparison instead of per line.
+    """
+    import numpy as np
+
+    with open(path, "rb") as f:
+        tokens = f.read().split()
+    first = np.frombuffer(b"".join(token[:1] for token in tokens), dtype=np.uint8)
+    return np.isin(first, np.frombuffer(b"Tt1", dtype=np.uint8))
+
+
+def _fast_loadtxt(path: str, dtype: type) -> "np.ndarray":
+    """Load an array from a .npy/.npz file or a whitespace separated text file
+
+    Binary files are read with np.load, boolean text files with
+    _load_bool_mask, other text files with pandas if available, which is much
+    faster than np.loadtxt, otherwise with np.loadtxt.
+    """
+    import numpy as np
+
+    if path.endswith(".npy"):
+        return np.load(path)
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            return archive[archive.files[0]]
+    if dtype is bool:
+        return _load_bool_mask(path)
+    try:
+        import pandas
+
+        return (
+            pandas.read_csv(path, header=None, dtype=dtype, sep=r"\s+")
+            .to_numpy()
+            .squeeze()
+        )
+    except (ImportError, ValueError):
+        return np.loadtxt(path, dtype=dtype)
+
+
+def _cache_dir() -> str:
+    """Directory for converted text inputs, $XDG_CACHE_HOME/sunblocker or ~/.cache/sunblocker"""
+    import os
+
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
     )
-    args = parser.parse_args()
+    return os.path.join(root, "sunblocker")
+
+
+def _mmap_loadtxt(path: str, dtype: type) -> "np.ndarray":
+    """Memory-map an array from a .npy file or a text file
+
+    A text file is converted once into a .npy file in the user cache
+    directory (see _cache_dir), never next to the text file. The cache file
+    is named after the absolute path, modification time, size and dtype of
+    the text file, so it is only reused while the text file is unchanged.
+    If the cache cannot be written, the array is returned in memory instead.
+    """
+    import hashlib
+    import os
+    import tempfile
+
+    import numpy as np
+
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return _fast_loadtxt(path, dtype)
+    key = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}\0{np.dtype(dtype).str}"
+    cache = os.path.join(_cache_dir(), hashlib.sha1(key.encode()).hexdigest() + ".npy")
+    try:
+        return np.load(cache, mmap_mode="r")
+    except (OSError, ValueError):
+        pass
+
+    array = _fast_loadtxt(path, dtype)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        # Write to a temporary file first, so a concurrent run never maps a partial cache
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(cache))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        return array
+    return np.load(cache, mmap_mode="r")
+
+
+def _is_value(arg: str) -> bool:
+    """Tell whether an argument is a value rather than an option, as argparse does
+
+    Besides anything not starting with '-', a lone '-', and arguments that
+    match no option but look like negative numbers or contain a space are
+    values.
+    """
+    if not arg.startswith("-") or arg == "-":
+        return True
+    if arg == "--" or _match(arg, fail=False):
+        return False
+    return bool(_NEGATIVE_NUMBER.match(arg)) or " " in arg
+
+
+def _match(arg: str, fail: bool = True) -> "tuple[str, str | None] | None":
+    """Find the flag an option argument refers to, as argparse does
+
+    Returns the flag and the value attached to it, or None for no value.
+    Values are attached with '=' ('--threshold=5', '-r=5') or, for short
+    options, directly ('-r5'). Long options may be abbreviated as long as the
+    abbreviation is unambiguous ('--thresho'). If nothing matches, exits with
+    an error or, with fail=False, returns None.
+    """
+    if arg in _ALL_FLAGS:
+        return arg, None
+    flag, equals, value = arg.partition("=")
+    if equals and flag in _ALL_FLAGS:
+        return flag, value
+    if arg.startswith("--"):
+        matches = [
+            (option, value if equals else None)
+            for option in _ALL_FLAGS
+            if option.startswith(flag)
+        ]
+    else:
+        matches = [
+            (option, arg[2:]) if option == arg[:2] else (option, None)
+            for option in _ALL_FLAGS
+            if option == arg[:2] or option.startswith(arg)
+        ]
+    if len(matches) == 1:
+        return matches[0]
+    if not fail:
+        return None
+    if matches:
+        _error(
+            f"ambiguous option: {flag if arg.startswith('--') else arg} could match "
+            + ", ".join(option for option, _ in matches)
+        )
+    _error(f"unrecognized arguments: {arg}")
+
+
+def parse_args() -> SimpleNamespace:
+    """Command line interface for SunBlocker"""
+    argv = sys.argv[1:]
+
+    # As in argparse, string defaults are passed through the option type
+    args = SimpleNamespace()
+    for _, long, kwargs in _OPTIONS:
+        default = kwargs.get("default", False)
+        if isinstance(default, str):
+            default = kwargs["type"](default)
+        setattr(args, long[2:], default)
+    positionals = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        # Everything after '--' is positional
+        if arg == "--":
+            positionals.extend(argv[i:])
+            break
+        if _is_value(arg):
+            positionals.append(arg)
+            continue
+        flag, value = _match(arg)
+        # Flags without a value can be combined behind one dash, as in '-Vy'
+        while flag in _HELP_FLAGS or "action" in _FLAGS[flag][2]:
+            if flag in _HELP_FLAGS:
+                from sunblocker._help import HELP
+
+                sys.stdout.write(HELP)
+                sys.exit(0)
+            setattr(args, _FLAGS[flag][1][2:], True)
+            if value is None:
+                break
+            if flag.startswith("--") or "-" + value[:1] not in _ALL_FLAGS:
+                _error(f"argument {flag}: ignored explicit argument '{value}'")
+            flag, value = "-" + value[0], value[1:] or None
+        else:
+            dest, kwargs = _FLAGS[flag][1][2:], _FLAGS[flag][2]
+            nargs = kwargs.get("nargs")
+            if nargs:
+                values = []
+                while (
+                    value is None
+                    and len(values) < nargs
+                    and i < len(argv)
+                    and _is_value(argv[i])
+                ):
+                    values.append(argv[i])
+                    i += 1
+                if value is not None or len(values) < nargs:
+                    _error(f"argument {flag}: expected {nargs} arguments")
+            elif value is not None:
+                values = [value]
+            elif i < len(argv) and _is_value(argv[i]):
+                values = [argv[i]]
+                i += 1
+            else:
+                _error(f"argument {flag}: expected one argument")
+            for j, value in enumerate(values):
+                try:
+                    values[j] = kwargs["type"](value)
+                except ValueError:
+                    _error(
+                        f"argument {flag}: invalid {kwargs['type'].__name__} value: '{value}'"
+                    )
+            if "choices" in kwargs and values[0] not in kwargs["choices"]:
+                _error(f"argument {flag}: invalid choice: '{values[0]}'")
+            setattr(args, dest, values if nargs else values[0])
+
+    # Like argparse, the last positional is the outset and all others the inset
+    if len(positionals) < 2:
+        _error("the following arguments are required: inset, outset")
+    args.inset, args.outset = positionals[:-1], positionals[-1:]
     return args
 
 
-def cli() -> None:
-    args = parse_args()
+def _postprocess_args(args: SimpleNamespace) -> dict:
+    """Turn parsed command line arguments into keyword arguments for run()
 
-    blocker = Sunblocker(
-        verb=args.verbose,
-        debug=args.debug,
-    )
-    if args.channels:
-        args.channels = np.loadtxt(args.channels, dtype=bool)
+    Loads the channels and baselines files and converts the sun times and the
+    horizon into astropy Quantities.
+    """
+    from astropy import units
 
+    # The namespace is not used afterwards, so its dict can be reused as is
+    kwargs = vars(args)
+    if args.channels:
+        kwargs["channels"] = _mmap_loadtxt(args.channels, dtype=bool)
     if args.baselines:
-        args.baselines = np.loadtxt(args.baselines, dtype=int)
-
-    blocker.phazer(
-        inset=args.inset,
-        outset=args.outset,
-        col=args.col,
-        channels=args.channels,
-        baselines=args.baselines,
-        fields=args.fields,
-        imsize=args.imsize,
-        cell=args.cell,
-        mode=args.mode,
-        pol=args.pol,
-        threshmode=args.threshmode,
-        threshold=args.threshold,
-        radrange=args.radrange,
-        angle=args.angle,
-        flagonlyday=args.flagonlyday,
-        vampirisms=args.vampirisms,
-        avantsoleil=args.avantsoleil * units.minute,
-        apresnuit=args.apresnuit * units.minute,
-        avantnuit=args.avantnuit * units.minute,
-        apresoleil=args.apresoleil * units.minute,
-        horizon=-args.horizon * units.arcmin,
-        nononsoleil=args.nononsoleil,
-        uvmin=args.uvmin,
-        uvmax=args.uvmax,
-        show=args.show,
-        showdir=args.showdir,
-        dryrun=args.dryrun,
+        kwargs["baselines"] = _mmap_loadtxt(args.baselines, dtype=int)
+    (
+        kwargs["avantsoleil"],
+        kwargs["apresnuit"],
+        kwargs["avantnuit"],
+        kwargs["apresoleil"],
+    ) = units.Quantity(kwargs.pop("times"), units.minute)
+    kwargs["horizon"] = units.Quantity(-args.horizon, units.arcmin)
+    return kwargs
+
+
+def run(inset, outset=None, verbose=False, debug=False, **kwargs) -> None:
+    """Run Sunblocker.phazer without going through the command line
+
+    Input:
+    inset (str or list of str)        : Input data set(s)
+    outset (None, str, or list of str): Output data set(s), see Sunblocker.phazer
+    verbose (bool)                    : Log at INFO level
+    debug (bool)                      : Log at DEBUG level
+    kwargs                            : Any further parameters of Sunblocker.phazer
+    """
+    import logging
+
+    from sunblocker.loggers import configure
+
+    configure(logging.DEBUG if debug else logging.INFO if verbose else logging.WARNING)
+
+    # Heavy imports only once we know the pipeline is actually going to run
+    from sunblocker.sunblocker import Sunblocker
+
+    blocker = Sunblocker(
+        verb=verbose,
+        debug=debug,
     )
+    blocker.phazer(inset=inset, outset=outset, **kwargs)
+
+
+def cli() -> None:
+    if len(sys.argv) <= 1:
+        sys.stderr.write(_USAGE)
+        sys.exit(2)
+    run(**_postprocess_args(parse_args()))
 
 
 if __name__ == "__main__":
-    sys.exit(cli())
+    raise SystemExit(cli())
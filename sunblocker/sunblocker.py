@@ -7,18 +7,27 @@ Taylored towards method phazer, aimed at removing solar interference from interf
 Methods:
     opensilent          - Opening inset with pyrap as a table suppressing any feedback from pyrap
     gaussian            - Gaussian function
+    stokes              - Combine two polarisations into Stokes I or Q
     wedge_around_centre - Return a boolean array selecting points in a 2-D wedge
+    selwith_wedges      - Return a boolean array selecting points in any of several 2-D wedges
+    sigmaclip           - Iteratively clip data around the median using MAD statistics
     histoclip           - Measure sigma and return a mask indicating data at a distance larger than threshold times sigma from the average
     readdata            - Open a data set inset and return a few tables
+    truruns             - Find the runs of consecutive True values in a boolean array
+    flagrows            - Flag selected rows in the FLAG column of an open data set
     phazer              - Flag Measurement Set based on scalarly averaged data
+    writeflags          - Apply row flags to a number of data sets
 
 Copyright (c) 2017 Gyula Istvan Geza Jozsa, Paolo Serra, Kshitij Thorat, Sphesihle Makhatini, NRF (Square Kilometre Array South Africa) - All Rights Reserved
 
     
 """
+import concurrent.futures
+import contextlib
 import logging
 import os
 import sys
+from multiprocessing import resource_tracker, shared_memory
 
 import astropy.coordinates as coordinates
 import astropy.time as time
@@ -30,23 +39,29 @@ import numpy as np
 import pyrap.tables as tables
 import scipy.constants as scconstants
 import scipy.optimize as opt
-from astropy.stats import mad_std, sigma_clip
+from astropy.stats import mad_std
 from matplotlib.patches import PathPatch
 from matplotlib.path import Path
 from scipy import stats
 from tqdm.auto import tqdm
 
-from sunblocker.loggers import logger
+from sunblocker.loggers import configure, logger
 
 matplotlib.use("Agg")
 
 
 class Sunblocker:
     def __init__(self, verb=False, debug=False):
-        if verb:
-            logger.setLevel(logging.INFO)
         if debug:
-            logger.setLevel(logging.DEBUG)
+            configure(logging.DEBUG)
+        elif verb:
+            configure(logging.INFO)
+
+        # Average frequency and antenna names per data set, these are small but slow to read from the subtables
+        self._metadata = {}
+
+        # Block of True values written by flagrows, kept between calls and data sets with the same FLAG cell shape
+        self._flagblock = None
 
     def opensilent(self, inset=None, readonly=True):
         """
@@ -85,6 +100,33 @@ class Sunblocker:
         """
         return amp * np.exp(-0.5 * np.power((x - cent) / sigma, 2))
 
+    def stokes(self, data, flags, sign):
+        """
+        Combine first and last polarisation into Stokes I or Q in a single pass
+
+        Input:
+        data (ndarray)  : visibilities, shape (nrows, nchans, npols)
+        flags (ndarray) : flags, same shape as data
+        sign (int)      : +1 for Stokes I, -1 for Stokes Q
+
+        Output:
+        stokes (ndarray)  : average of unflagged first and (signed) last polarisation, nan where none is unflagged
+        stflags (ndarray) : number of unflagged polarisations contributing
+        """
+        f0 = ~flags[:, :, 0]
+        fi = ~flags[:, :, -1]
+        stflags = f0.view(np.uint8) + fi.view(np.uint8)
+
+        # Accumulate into one output buffer, skipping flagged values instead of multiplying them by zero
+        # Single precision is kept (complex64 is the usual on-disk type), which halves the memory traffic downstream
+        stokes = np.zeros(data.shape[:2], dtype=np.result_type(data.dtype, np.float32))
+        np.copyto(stokes, data[:, :, 0], where=f0)
+        combine = np.add if sign > 0 else np.subtract
+        combine(stokes, data[:, :, -1], out=stokes, where=fi)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(stokes, stflags, out=stokes)
+        return stokes, stflags
+
     def wedge_around_centre(self, coord, radrange, angle):
         """
         Return a boolean array selecting points in a 2-D wedge
@@ -114,9 +156,12 @@ class Sunblocker:
         a = np.linspace(alpha_min, alpha_max, npoints)
         s = np.sin(a)
         c = np.cos(a)
-        arc1 = zip(rmax * s, rmax * c)
-        arc2 = zip(rmin * np.flipud(s), rmin * np.flipud(c))
-        polygon = arc1 + arc2 + [arc1[0]]
+        polygon = np.empty((2 * npoints + 1, 2))
+        polygon[:npoints, 0] = rmax * s
+        polygon[:npoints, 1] = rmax * c
+        polygon[npoints:-1, 0] = rmin * s[::-1]
+        polygon[npoints:-1, 1] = rmin * c[::-1]
+        polygon[-1] = polygon[0]
         path = Path(polygon)
         return path
 
@@ -133,9 +178,96 @@ class Sunblocker:
         Returns a boolean array flagging points inside the polygon as True
         """
 
-        # Create array of tuples
-        points = np.array(zip(uvcoords[:, 0], uvcoords[:, 1]))
-        boolarray = path.contains_points(points)
+        boolarray = path.contains_points(np.asarray(uvcoords)[:, :2])
+        return boolarray
+
+    def sigmaclip(self, data, sigma):
+        """
+        Iteratively clip data beyond sigma times the MAD standard deviation from the median
+
+        Input:
+        data (ndarray) : Input data, one dimension, finite values only
+        sigma (float)  : Clipping distance in units of the standard deviation
+
+        Output:
+        sigmaclip (ndarray): Data remaining when clipping does not remove any further points
+        """
+        clipped = data
+        while clipped.size:
+            med = np.median(clipped)
+            std = mad_std(clipped)
+            keep = (clipped >= med - sigma * std) & (clipped <= med + sigma * std)
+            if keep.all():
+                break
+            clipped = clipped[keep]
+        return clipped
+
+    def selwith_wedges(self, centres, uvcoords, radrange, angle, maxcandidates=1048576):
+        """
+        Return a boolean array indicating coordinates (pairs) inside any of the wedges around centres
+
+        Input:
+        centres (array-like)  : nx2 array-like of coordinates of the centres of the wedges
+        uvcoords (array-like) : mx2 array-like of coordinates of points
+        radrange (float)      : radial range of the wedges
+        angle (float)         : width of the wedges in degrees
+        maxcandidates (int)   : maximum number of (wedge, point) pairs tested at once
+
+        Output:
+        array-like(dtype = bool) selwith_wedges:
+
+        The wedges are the ones described in wedge_around_centre, but
+        the test is done in polar coordinates instead of with a
+        polygon. Points are sorted by radius once, such that for each
+        wedge only the points within its radial range are tested for
+        their angle, by comparing the cosine of the angle between point
+        and centre (from the dot product) with the cosine of half the
+        wedge angle. These tests are done for blocks of wedges at a
+        time.
+        """
+        centres = np.asarray(centres)
+        uvcoords = np.asarray(uvcoords)
+
+        # Sort the points by radius once and keep their coordinates in that order, such that the candidates of a wedge are contiguous
+        r = np.hypot(uvcoords[:, 0], uvcoords[:, 1])
+        order = np.argsort(r)
+        rsorted = r[order]
+        usorted = uvcoords[order, 0]
+        vsorted = uvcoords[order, 1]
+        rcentres = np.hypot(centres[:, 0], centres[:, 1])
+        cosangle = np.cos(np.pi * angle / 180.0 / 2.0)
+
+        # Radial range of each wedge as a slice of the points sorted by radius
+        first = np.searchsorted(rsorted, rcentres - radrange / 2.0, side="left")
+        last = np.searchsorted(rsorted, rcentres + radrange / 2.0, side="right")
+
+        # Test the candidates of many wedges at once, in blocks of at most maxcandidates points to bound memory
+        lengths = last - first
+        ends = np.cumsum(lengths)
+        boolarray = np.zeros(r.shape, dtype=bool)
+        start = 0
+        while start < rcentres.size:
+            stop = max(
+                np.searchsorted(
+                    ends, ends[start] - lengths[start] + maxcandidates, side="right"
+                ),
+                start + 1,
+            )
+            blocklengths = lengths[start:stop]
+            wedge = np.repeat(np.arange(start, stop), blocklengths)
+            offset = np.arange(wedge.size) - np.repeat(
+                np.cumsum(blocklengths) - blocklengths, blocklengths
+            )
+            inrange = first[wedge] + offset
+            # A point is within half the angle of the centre if the cosine between both vectors is large enough, no arctan needed
+            dot = (
+                usorted[inrange] * centres[wedge, 0]
+                + vsorted[inrange] * centres[wedge, 1]
+            )
+            inwedge = dot >= cosangle * rsorted[inrange] * rcentres[wedge]
+            boolarray[order[inrange[inwedge]]] = True
+            logger.info("extended %d points.", stop)
+            start = stop
         return boolarray
 
     def histoclip(
@@ -148,6 +280,7 @@ class Sunblocker:
         threshold=5.0,
         ax=None,
         title="",
+        scratch=None,
     ):
         """Measure sigma and return a mask indicating data at a distance larger than threshold times sigma from the average
 
@@ -155,11 +288,12 @@ class Sunblocker:
         data (ndarray, type = float)   : Input data, one dimension
         mask (ndarray, type = bool)    : Mask indicating data points to ignore for evaluation, same shape as data
         unflags (ndarray, type = bool) : Mask indicating data points not to flag
-        gruvcoord (nx2 ndarray, type = float): Array of the same size of data x 2 denoting grid positions of the data
+        gruvcoord (nx2 ndarray, type = int or float): Array of the same size of data x 2 denoting grid positions (or integer grid indices) of the data
         threshmode (string)            : Method to determine sigma, 'fit': fit Gaussian at the max to determine sigma, 'fixed': threshold is in absolute units (sigma is 1.), 'mad': use MAD statistics to derive standard deviation, otherwise standard deviation
         threshold (float)              : Distance from average beyond which data are flagged in units of sigma
         show (bool)                    : Show histogram to monitor what is happening
         title (string)                 : title of histogram
+        scratch (dict)                 : Buffers kept between calls with the same gruvcoord, or None
 
         Output:
         histoclip (ndarray, type = bool): Mask indicating points with a distance of larger than threshold*sigma from average (or peak position)
@@ -181,99 +315,115 @@ class Sunblocker:
 
         """
 
-        # Copy data
-        av = np.copy(data)
+        # Data are only read, so no copy is needed
+        av = data
 
         # This does not help
         # av[mask==True] = np.nan
 
-        # Make a grid
-        ugrid = np.unique(gruvcoord[:, 0])
-        vgrid = np.unique(gruvcoord[:, 1])
+        # Make a grid, and get the grid indices of all data points
+        if np.issubdtype(gruvcoord.dtype, np.integer):
+            # Integer grid indices only need an offset, no sorting
+            uindex = gruvcoord[:, 0] - gruvcoord[:, 0].min()
+            vindex = gruvcoord[:, 1] - gruvcoord[:, 1].min()
+            nu, nv = int(uindex.max()) + 1, int(vindex.max()) + 1
+        else:
+            ugrid, uindex = np.unique(gruvcoord[:, 0], return_inverse=True)
+            vgrid, vindex = np.unique(gruvcoord[:, 1], return_inverse=True)
+            nu, nv = ugrid.size, vgrid.size
 
         # Do this again. We really want a histogram only with values related to the unflagged visibilities
-        uvgridded = np.zeros((ugrid.size * vgrid.size), dtype=float) + np.nan
-        i = 0
-        for uu in ugrid:
-            for vv in vgrid:
-                active_visibs = av[
-                    (gruvcoord[:, 0] == uu) * (gruvcoord[:, 1] == vv) * (mask != True)
-                ]
-                if active_visibs.size == 0:
-                    uvgridded[i] = np.nan
-                else:
-                    uvgridded[i] = active_visibs[0]
-                i = i + 1
+        # Each cell gets the value of its first unmasked data point, empty cells are nan
+        if scratch is None:
+            scratch = {}
+        uvgridded = scratch.get("uvgridded")
+        if uvgridded is None or uvgridded.size != nu * nv:
+            uvgridded = scratch["uvgridded"] = np.empty(nu * nv)
+        uvgridded.fill(np.nan)
+        active = np.flatnonzero(mask != True)
+        cells, first = np.unique(
+            uindex[active].astype(np.int64) * nv + vindex[active], return_index=True
+        )
+        uvgridded[cells] = av[active[first]]
 
         # Average data, then look for shape
         # av = np.nanmean(ampar,axis=1)
-        npoints = uvgridded[np.isfinite(uvgridded)].size
-        logger.info("grid has {:d} nonzero points.".format(npoints))
+        finite = uvgridded[np.isfinite(uvgridded)]
+        npoints = finite.size
+        logger.info("grid has %d nonzero points.", npoints)
         if npoints < 3:
             logger.info(
                 "This is not sufficient for any statistics, returning no flags."
             )
             return np.zeros(av.shape, dtype=bool)
 
-        # Do some sigma clipping
-        uvgridded_clipped = sigma_clip(
-            uvgridded,
-            sigma=threshold,
-            maxiters=None,
-            stdfunc=mad_std,
-            cenfunc=np.nanmedian,
-            masked=False,
-        )
-        npoints_clipped = uvgridded_clipped[np.isfinite(uvgridded_clipped)].size
-
-        # Find average and standard deviation
-        average = np.nanmean(uvgridded_clipped)
-        stdev = np.nanstd(uvgridded_clipped)
-
-        logger.info("average: {}, stdev: {}".format(average, stdev))
-
-        if average == np.nan:
-            logger.info("cannot calculate average, returing no flags")
-            return np.zeros(av.shape, dtype=bool)
-
-        if stdev == np.nan:
-            logger.info("cannot calculate standard deviation, returing no flags")
-            return np.zeros(av.shape, dtype=bool)
-
-        med = np.nanmedian(uvgridded_clipped)
-        mad = mad_std(uvgridded_clipped)
-
-        if threshmode == "fit" or ax != None:
-            # Build a histogram
-            hist, bin_edges = np.histogram(
-                uvgridded_clipped[np.isfinite(uvgridded_clipped)],
-                bins=int(np.sqrt(npoints_clipped)) + 1,
-            )
-            bin_centers = bin_edges[:-1] + 0.5 * (bin_edges[1:] - bin_edges[:-1])
-            widthes = bin_edges[1:] - bin_edges[:-1]
-
-            # Find maximum in histogram
-            maxhi = np.amax(hist)
-            maxhiposval = bin_centers[np.argmax(hist)]
-
-            # Fit a Gaussian
-            try:
-                popt, pcov = opt.curve_fit(
-                    self.gaussian,
-                    bin_centers,
-                    hist,
-                    p0=[maxhiposval, maxhi, stdev / 2.0],
-                )
-            except:
-                popt = np.array(
-                    [
-                        average,
-                        widthes[0] * npoints / (np.sqrt(2 * np.pi) * stdev),
-                        stdev,
-                    ]
+        # An absolute threshold needs no statistics, unless they are shown
+        absolute = threshmode in ("fixed", "abs")
+        if not absolute or ax != None:
+            # Do some sigma clipping on the finite values, median and MAD as centre and width
+            finite_clipped = self.sigmaclip(finite, threshold)
+            npoints_clipped = finite_clipped.size
+
+            # Find average and standard deviation
+            average = finite_clipped.mean()
+            stdev = finite_clipped.std()
+
+            logger.info("average: %s, stdev: %s", average, stdev)
+
+            if np.isnan(average):
+                logger.info("cannot calculate average, returing no flags")
+                return np.zeros(av.shape, dtype=bool)
+
+            if np.isnan(stdev):
+                logger.info("cannot calculate standard deviation, returing no flags")
+                return np.zeros(av.shape, dtype=bool)
+
+            med = np.median(finite_clipped)
+            mad = mad_std(finite_clipped)
+
+            if threshmode == "fit" or ax != None:
+                # Build a histogram, passing the range explicitly keeps numpy on its uniform-bin fast path
+                # The number of bins is reused for the unclipped histogram when plotting
+                nbins = int(np.sqrt(npoints_clipped)) + 1
+                hist, bin_edges = np.histogram(
+                    finite_clipped,
+                    bins=nbins,
+                    range=(finite_clipped.min(), finite_clipped.max()),
                 )
+                widthes = np.diff(bin_edges)
+                bin_centers = bin_edges[:-1] + 0.5 * widthes
+
+                # Initial guess for the Gaussian fit: a parabola fitted to the logarithm of the histogram gives its parameters in one linear solve
+                # Weighting with the counts keeps sparsely populated wings from dominating the guess
+                # The log-parabola is biased by the low-count wings, so it only serves as a starting point for the least-squares fit
+                filled = hist > 0
+                if np.count_nonzero(filled) >= 3:
+                    x = bin_centers[filled]
+                    w = hist[filled]
+                    design = np.column_stack((x * x, x, np.ones_like(x))) * w[:, None]
+                    c2, c1, c0 = np.linalg.lstsq(design, w * np.log(w), rcond=None)[0]
+                else:
+                    c2 = 0.0
+                if c2 < 0.0:
+                    cent = -c1 / (2.0 * c2)
+                    p0 = [cent, np.exp(c0 - c1 * c1 / (4.0 * c2)), np.sqrt(-0.5 / c2)]
+                else:
+                    # Not a concave histogram, start at the maximum of the histogram
+                    p0 = [bin_centers[np.argmax(hist)], np.amax(hist), stdev / 2.0]
+
+                # Fit a Gaussian
+                try:
+                    popt, pcov = opt.curve_fit(self.gaussian, bin_centers, hist, p0=p0)
+                except:
+                    popt = np.array(
+                        [
+                            average,
+                            widthes[0] * npoints / (np.sqrt(2 * np.pi) * stdev),
+                            stdev,
+                        ]
+                    )
 
-        if threshmode == "abs":
+        if absolute:
             std = 1.0
             ave = 0.0
         if threshmode == "std":
@@ -315,19 +465,29 @@ class Sunblocker:
             # In case of using only stats, this is right on top
             fitted = self.gaussian(showgouse, popt[0], popt[1], popt[2])
 
-            hists, bins, _ = ax.hist(
-                uvgridded_clipped,
-                bins=int(np.sqrt(npoints_clipped)) + 1,
+            # Draw the histograms from counts, the clipped one is the histogram built above
+            hists = hist / (hist.sum() * widthes)
+            ax.bar(
+                bin_edges[:-1],
+                hists,
+                width=widthes,
+                align="edge",
                 label="Clipped",
                 alpha=0.7,
+            )
+            unclipped_hist, unclipped_edges = np.histogram(
+                finite,
+                bins=nbins,
+                range=(finite.min(), finite.max()),
                 density=True,
             )
-            ax.hist(
-                uvgridded,
-                bins=int(np.sqrt(npoints_clipped)) + 1,
+            ax.bar(
+                unclipped_edges[:-1],
+                unclipped_hist,
+                width=np.diff(unclipped_edges),
+                align="edge",
                 label="Unclipped",
                 alpha=0.5,
-                density=True,
                 zorder=10,
             )
 
@@ -352,7 +512,7 @@ class Sunblocker:
                 ls="--",
                 label=f"Upper threshold = {average + threshold * stdev:0.1f}",
             )
-            ax.set_xlim(0, np.nanmax(uvgridded))
+            ax.set_xlim(0, finite.max())
             ax.set_title(title)
             ax.set_xlabel("Amplitude")
             ax.set_ylabel("PDF")
@@ -368,6 +528,7 @@ class Sunblocker:
         channels=None,
         baselines=None,
         pol="i",
+        nrowchunk=100000,
     ):
         """Open a data set inset and return a few tables
 
@@ -378,6 +539,7 @@ class Sunblocker:
         channels (bool array)  : dtype = bool array with True for channels to base the analysis on "False" channels will be ignored
         baselines (array)      : nx2 array with antenna pairs for baselines to base the analysis on
         pol (str)              : Polarization selection, Stokes 'i', or Stokes 'q'
+        nrowchunk (int)        : Number of rows to read and reduce to Stokes at a time
 
         Output:
         readdate: data (complex array, array of single visibilities, Stokes I or Q per frequency), flags (bool array), uv (float array, uv coordinates), antenna1 (int array), antenna2 (int array), antennanames (string array)
@@ -402,58 +564,34 @@ class Sunblocker:
         else:
             t = inset
 
-        # Read column (think, axes are by default ordered as time, frequency, polarization) and flags, which should have same dimension
-        logger.info("reading visibilities.")
-        data = t.getcol(col)
-        logger.info("reading original flags.")
-        flags = t.getcol("FLAG")
-
-        ### The following two lines belong to test 2
-        # print '1: shape'
-        # print data.shape
-        ###
-
-        # Divide uv coordinates by wavelength, for this use average frequencies in Hz
-        # If bandwidth becomes large, we have to come up with something better
-        logger.info("acquiring spectral information.")
-        avspecchan = np.average(t.SPECTRAL_WINDOW.getcol("CHAN_FREQ"))
-        logger.info(
-            "average wavelength is {:.3f} m.".format(scconstants.c / avspecchan)
-        )  # This is for testing: should be ~0.21 if local HI
-
-        logger.info("reading and calculating approximate uv coordinates.")
-        uv = t.getcol("UVW")[:, :2] * avspecchan / scconstants.c
-
         # Convert into desired stokes parameters and adjust mask
-        i = data.shape[2] - 1
-        stflags = np.logical_not(flags[:, :, 0]).astype(float) + np.logical_not(
-            flags[:, :, i]
-        ).astype(float)
-
         # if polarisation is i, then take either average or single value, flag the rest
         if pol == "i":
             logger.info("calculating Stokes I.")
-
-            # Calculate stokes i, reduce the number of polarizations to one, flag if not at least one pol is available
-            with np.errstate(divide="ignore", invalid="ignore"):
-                data = (
-                    data[:, :, 0] * np.logical_not(flags)[:, :, 0]
-                    + data[:, :, i] * np.logical_not(flags)[:, :, i]
-                ) / stflags
-            flags = stflags < 1.0
+            sign = 1
         elif pol == "q":
             logger.info("calculating Stokes Q.")
-
-            # Calculate stokes q, reduce the number of polarizations to one, flag everything if not both pols are available
-            with np.errstate(divide="ignore", invalid="ignore"):
-                data = (
-                    data[:, :, 0] * np.logical_not(flags)[:, :, 0]
-                    - data[:, :, i] * np.logical_not(flags)[:, :, i]
-                ) / stflags
-            flags = stflags < 2.0
+            sign = -1
         else:
             raise ("Polarisation must be i or q.")
 
+        # Divide uv coordinates by wavelength, for this use average frequencies in Hz
+        # If bandwidth becomes large, we have to come up with something better
+        logger.info("acquiring spectral information.")
+        if t.name() not in self._metadata:
+            self._metadata[t.name()] = (
+                np.average(t.SPECTRAL_WINDOW.getcol("CHAN_FREQ")),
+                t.ANTENNA.getcol("NAME"),
+            )
+        avspecchan, antennanames = self._metadata[t.name()]
+        logger.info(
+            "average wavelength is %.3f m.", scconstants.c / avspecchan
+        )  # This is for testing: should be ~0.21 if local HI
+
+        logger.info("reading and calculating approximate uv coordinates.")
+        uv = t.getcolslice("UVW", [0], [1]).reshape(-1, 2)
+        uv *= avspecchan / scconstants.c
+
         ### The following two lines belong to test 2
         # print '2: shape'
         # print data.shape
@@ -461,52 +599,75 @@ class Sunblocker:
 
         #        flags[:,:,0] = np.logical_not((stflags.astype(bool)))
 
-        # Also mask anything not listed in fields
-        if fields is not None:
-            logger.info("Selecting specified fields.")
-            field = t.getcol("FIELD")
-            select = np.zeros(field.shape, dtype=bool)
-            if isinstance(fields, list):
-                for i in fields:
-                    select |= field == i
-            else:
-                select |= field == fields
-
-            flags[np.logical_not(select), :] = True
-
         # Flag autocorrelations
         # print t.ANTENNA.getcol('NAME')[0]
         logger.info("reading antenna information.")
         antenna1 = t.getcol("ANTENNA1")
         antenna2 = t.getcol("ANTENNA2")
 
+        # Row selections are collected first, such that the flags are only written once
         logger.info("de-selecting autocorrelations (if any).")
-        flags[antenna1 == antenna2] = True
+        rowflags = antenna1 == antenna2
 
-        # Select channels and flag everything outside provided channels
-        if channels is not None:
-            logger.info("selecting specified channels.")
-            flags[:, np.logical_not(channels)] = True
+        # Also mask anything not listed in fields
+        if fields is not None:
+            logger.info("Selecting specified fields.")
+            field = t.getcol("FIELD_ID")
+            rowflags |= np.logical_not(np.isin(field, fields))
 
         # Select baselines and select everything outside provided baselines
         if baselines is not None:
             logger.info("selecting specified baselines.")
-            flags[
-                np.logical_not(
-                    [
-                        i in zip(np.array(baselines)[:, 0], np.array(baselines)[:, 1])
-                        or i
-                        in zip(np.array(baselines)[:, 1], np.array(baselines)[:, 0])
-                        for i in zip(antenna1, antenna2)
-                    ]
-                )
-            ] = True
+            # Pack each (unordered) antenna pair into a single integer key, lower antenna in the upper bits, and compare keys
+            bl = np.asarray(baselines, dtype=np.int64).reshape(-1, 2)
+            key = (np.minimum(antenna1, antenna2).astype(np.int64) << 16) | np.maximum(
+                antenna1, antenna2
+            )
+            allowed = (np.minimum(bl[:, 0], bl[:, 1]) << 16) | np.maximum(
+                bl[:, 0], bl[:, 1]
+            )
+            rowflags |= np.logical_not(np.isin(key, allowed))
 
-        # Now put all flagged data to nan:
-        logger.info("applying selections to data.")
-        data[flags] = np.nan
+        # Reduce the number of polarizations to one, flag if not at least one pol is available (Stokes I) or not both pols are available (Stokes Q)
+        if pol == "i":
+            minpols = 1
+        else:
+            minpols = 2
+
+        # Select channels and flag everything outside provided channels
+        if channels is not None:
+            logger.info("selecting specified channels.")
+            chanflags = np.logical_not(channels)
 
-        antennanames = t.ANTENNA.getcol("NAME")
+        # Read column (think, axes are by default ordered as time, frequency, polarization) and flags, which should have same dimension
+        # Read in chunks of rows and reduce each to Stokes right away, such that only one chunk of the full polarisation data is held at a time
+        # The selections are applied to each chunk while it is still in cache, setting all flagged data to nan
+        logger.info("reading visibilities and original flags.")
+        logger.info("applying selections to data.")
+        # The outputs are allocated up front, such that a table without rows returns empty arrays
+        # Their data type is the one returned by stokes
+        nrows = t.nrows()
+        if nrows > 0:
+            cell = t.getcell(col, 0)
+            nchans, dtype = cell.shape[0], np.result_type(cell.dtype, np.float32)
+        else:
+            nchans = int(np.max(t.SPECTRAL_WINDOW.getcol("NUM_CHAN"), initial=0))
+            dtype = np.complex64
+        data = np.empty((nrows, nchans), dtype=dtype)
+        flags = np.empty(data.shape, dtype=bool)
+        for start in range(0, nrows, nrowchunk):
+            chunkdata, chunkstflags = self.stokes(
+                t.getcol(col, start, nrowchunk),
+                t.getcol("FLAG", start, nrowchunk),
+                sign,
+            )
+            chunkflags = flags[start : start + nrowchunk]
+            np.less(chunkstflags, minpols, out=chunkflags)
+            chunkflags |= rowflags[start : start + nrowchunk, np.newaxis]
+            if channels is not None:
+                chunkflags |= chanflags
+            np.putmask(chunkdata, chunkflags, np.nan)
+            data[start : start + nrowchunk] = chunkdata
 
         # Close only if this has been a string
         if isinstance(inset, str):
@@ -514,6 +675,90 @@ class Sunblocker:
 
         return data, flags, uv, antenna1, antenna2, antennanames
 
+    def truruns(self, mask):
+        """
+        Find the runs of consecutive True values in a one-dimensional boolean array
+
+        Input:
+        mask (ndarray, type = bool) : one-dimensional mask
+
+        Output:
+        starts (ndarray, type = int) : index of the first element of each run
+        lengths (ndarray, type = int): number of elements in each run
+        """
+        mask = np.ascontiguousarray(mask, dtype=bool)
+
+        # Scan the mask eight elements (one 64-bit word) at a time and only look into the words containing True values
+        nbody = mask.size - mask.size % 8
+        words = np.flatnonzero(mask[:nbody].view(np.uint64))
+        candidates = np.concatenate(
+            (
+                (words[:, np.newaxis] * 8 + np.arange(8)).ravel(),
+                np.arange(nbody, mask.size),
+            )
+        )
+        trues = candidates[mask[candidates]]
+        if trues.size == 0:
+            return trues, trues
+
+        # A run ends where the next True value is not the next element
+        breaks = np.flatnonzero(np.diff(trues) != 1)
+        starts = trues[np.concatenate(([0], breaks + 1))]
+        ends = trues[np.append(breaks, trues.size - 1)] + 1
+        return starts, ends - starts
+
+    def flagrows(self, t, rowflags, blocksize=67108864):
+        """
+        Flag all channels and polarisations of selected rows in the FLAG column of an open data set
+
+        Input:
+        t (pyrap table)                   : data set opened for writing
+        rowflags (ndarray, type = bool)   : one entry per row, True for rows to flag
+        blocksize (int)                   : maximum number of flags written at once
+
+        Rows are only ever set to flagged, so the FLAG column does not
+        have to be read. Each run of consecutive rows to flag is
+        written at once, long runs in pieces of at most blocksize
+        flags, which bounds the memory used. Nothing is written if no
+        row is selected, and the search for runs is skipped if all
+        rows are selected.
+        """
+        # Check for nothing or everything to flag on the mask read as 64-bit words, eight rows at a time
+        rowflags = np.ascontiguousarray(rowflags, dtype=bool)
+        nbody = rowflags.size - rowflags.size % 8
+        words = rowflags[:nbody].view(np.uint64)
+        tail = rowflags[nbody:]
+        if not (words.any() or tail.any()):
+            logger.info("no rows to flag, FLAG column left untouched.")
+            return
+
+        # If all rows are flagged, there is a single run and no need to search for runs
+        if (words == np.uint64(0x0101010101010101)).all() and tail.all():
+            logger.info("flagging all rows.")
+            starts, lengths = np.array([0]), np.array([rowflags.size])
+        else:
+            starts, lengths = self.truruns(rowflags)
+
+        # One block of True values, long enough for the longest run but not longer than blocksize, serves all runs
+        # The block gets the shape and data type of a FLAG cell, such that it is written without conversion
+        cell = t.getcell("FLAG", 0)
+        nrowchunk = max(1, blocksize // max(1, cell.size))
+        nrowblock = min(lengths.max(), nrowchunk)
+        block = self._flagblock
+        if (
+            block is None
+            or block.shape[1:] != cell.shape
+            or block.dtype != cell.dtype
+            or block.shape[0] < nrowblock
+        ):
+            block = self._flagblock = np.ones(
+                (nrowblock,) + cell.shape, dtype=cell.dtype
+            )
+        for start, length in zip(starts, lengths):
+            for startrow in range(start, start + length, nrowblock):
+                nrow = min(nrowblock, start + length - startrow)
+                t.putcol("FLAG", block[:nrow], startrow=startrow, nrow=nrow)
+
     def phazer(
         self,
         inset=None,
@@ -543,6 +788,7 @@ class Sunblocker:
         show=None,
         showdir=".",
         dryrun=True,
+        nprocs=1,
     ):
         """Flag Measurement Set based on scalarly averaged data
 
@@ -575,6 +821,7 @@ class Sunblocker:
         show (bool)            : Show histogram and cutoff line in a viewgraph
         showdir (str)          : Directory to put viewgraphs in
         dryrun (bool)          : Do not apply flags, but (e.g. produce viewgraphs only)
+        nprocs (int)           : Number of processes reading input data sets in parallel
 
         Takes a number of input visibilities (column given by col) and
         selects a sub-set using the selection criteria col, channels
@@ -646,110 +893,107 @@ class Sunblocker:
         if len(inset) == 1:
             logger.info("reading one data set.")
         else:
-            logger.info("reading {:d} data sets.".format(len(inset)))
-
-        # Let's do this the primitive way, first read a data set then append everything else
-        logger.info("reading {:s}.".format(inset[0]))
-
-        nrows = [
-            0,
-        ]
-        tutu = self.opensilent(inset[0])
-        data, flags, uv, antenna1, antenna2, antennanames = self.readdata(
-            tutu,
-            col=col,
-            fields=fields,
-            channels=channels,
-            baselines=baselines,
-            pol=pol,
+            logger.info("reading %d data sets.", len(inset))
+
+        # Count the rows of all data sets first, such that the combined arrays can be allocated once from the total number of rows
+        # Only one data set is open at a time
+        nrows = [0]
+        for name in inset:
+            tutu = self.opensilent(name)
+            nrows.append(nrows[-1] + tutu.nrows())
+            if isinstance(name, str):
+                tutu.close()
+
+        # Reading the data sets is independent, so it can be spread over processes, each opening its own data set
+        readargs = dict(
+            col=col, fields=fields, channels=channels, baselines=baselines, pol=pol
         )
+        parallel = nprocs > 1 and len(inset) > 1
+        if parallel:
+            # Workers must share the resource tracker of this process, which releases the shared memory
+            resource_tracker.ensure_running()
+            executor = concurrent.futures.ProcessPoolExecutor(min(nprocs, len(inset)))
+        else:
+            executor = contextlib.nullcontext()
+        with executor:
+            reads = []
+            if parallel:
+                reads = [executor.submit(_readshared, name, readargs) for name in inset]
+            for i in tqdm(range(len(inset)), desc="Reading data"):
+                logger.info("reading %s.", inset[i])
+                tutu = self.opensilent(inset[i])
+                if reads:
+                    (
+                        shared,
+                        uvplus,
+                        antenna1plus,
+                        antenna2plus,
+                        antennanamesplus,
+                    ) = reads[i].result()
+                    dataplus, flagsplus = _fromshared(shared)
+                else:
+                    (
+                        dataplus,
+                        flagsplus,
+                        uvplus,
+                        antenna1plus,
+                        antenna2plus,
+                        antennanamesplus,
+                    ) = self.readdata(tutu, **readargs)
+
+                # This is a list where all visibilities taken by night are set to True, False otherwise)
+                if vampirisms or flagonlyday:
+                    dayflagsplus = self.vampirisms(
+                        tutu,
+                        dryrun=True,
+                        avantsoleil=avantsoleil,
+                        apresnuit=apresnuit,
+                        avantnuit=avantnuit,
+                        apresoleil=apresoleil,
+                        horizon=horizon,
+                        nononsoleil=nononsoleil,
+                        flinvert=True,
+                    )
 
-        #        print 'flags shape', flags.shape
-        #        print 'data shape', data.shape
-        #        print 'any?', np.any(flags)
-
-        # This is a list where all visibilities taken by night are set to True, False otherwise)
-        if vampirisms or flagonlyday:
-            dayflags = self.vampirisms(
-                tutu,
-                dryrun=True,
-                avantsoleil=avantsoleil,
-                apresnuit=apresnuit,
-                avantnuit=avantnuit,
-                apresoleil=apresoleil,
-                horizon=horizon,
-                nononsoleil=nononsoleil,
-                flinvert=True,
-            )
-
-        # Now additionally flag all night visibilities if user wants
-        if vampirisms:
-            logger.info("applying vampirisms to dataset {:s}.".format(inset[0]))
-
-            #            print'finding out about dayflags:'
-            #            print np.all(dayflags)
-            flags[dayflags, :] = True
-            data[flags] = np.nan
-
-        tutu.close()
-        nrows.append(data.shape[0])
+                # Now additionally flag all night visibilities if user wants
+                if vampirisms:
+                    logger.info("applying vampirisms to dataset %s.", inset[i])
+                    # This flags all visibilities taken by night (sets those visibs to True)
 
-        for i in tqdm(range(1, len(inset)), desc="Reading data"):
-            logger.info("reading {:s}.".format(inset[i]))
-            tutu = self.opensilent(inset[i])
-            (
-                dataplus,
-                flagsplus,
-                uvplus,
-                antenna1plus,
-                antenna2plus,
-                antennanamesplus,
-            ) = self.readdata(
-                tutu,
-                col=col,
-                fields=fields,
-                channels=channels,
-                pol=pol,
-            )
-            if vampirisms or flagonlyday:
-                dayflagsplus = self.vampirisms(
-                    tutu,
-                    dryrun=True,
-                    avantsoleil=avantsoleil,
-                    apresnuit=apresnuit,
-                    avantnuit=avantnuit,
-                    apresoleil=apresoleil,
-                    horizon=horizon,
-                    nononsoleil=nononsoleil,
-                    flinvert=True,
-                )
+                    flagsplus |= dayflagsplus[:, np.newaxis]
+                    np.putmask(dataplus, flagsplus, np.nan)
+                if isinstance(inset[i], str):
+                    tutu.close()
 
-            if vampirisms:
-                logger.info("applying vampirisms to dataset {:s}.".format(inset[i]))
-                # This flags all visibilities taken by night (sets those visibs to True)
-
-                flagsplus[dayflagsplus, :] = True
-                dataplus[flagsplus] = np.nan
-            tutu.close()
-
-            data = np.concatenate((data, dataplus), axis=0)
-            flags = np.concatenate((flags, flagsplus), axis=0)
-            if vampirisms or flagonlyday:
-                dayflags = np.concatenate((dayflags, dayflagsplus), axis=0)
-            uv = np.concatenate((uv, uvplus), axis=0)
-            antenna1 = np.concatenate((antenna1, antenna1plus), axis=0)
-            antenna2 = np.concatenate((antenna2, antenna2plus), axis=0)
-
-            # Antenna names is different. Just check if they are the same
-            if not np.all(antennanames == antennanamesplus):
-                logger.warning(
+                if i == 0:
+                    data = np.empty(
+                        (nrows[-1],) + dataplus.shape[1:], dtype=dataplus.dtype
+                    )
+                    flags = np.empty(data.shape, dtype=bool)
+                    if vampirisms or flagonlyday:
+                        dayflags = np.empty(nrows[-1], dtype=bool)
+                    uv = np.empty((nrows[-1], 2), dtype=uvplus.dtype)
+                    antenna1 = np.empty(nrows[-1], dtype=antenna1plus.dtype)
+                    antenna2 = np.empty(nrows[-1], dtype=antenna2plus.dtype)
+                    antennanames = antennanamesplus
+
+                # Antenna names is different. Just check if they are the same
+                elif not np.all(antennanames == antennanamesplus):
+                    logger.warning(
+                        """
+                    It appears that the antennas in data sets differ.
+                    This means that baseline selection (using parameter baselines) should not be used.
+                    This means that only model 'all' should be used.
                     """
-                It appears that the antennas in data sets differ.
-                This means that baseline selection (using parameter baselines) should not be used.
-                This means that only model 'all' should be used.
-                """
-                )
-            nrows.append(data.shape[0])
+                    )
+
+                data[nrows[i] : nrows[i + 1]] = dataplus
+                flags[nrows[i] : nrows[i + 1]] = flagsplus
+                if vampirisms or flagonlyday:
+                    dayflags[nrows[i] : nrows[i + 1]] = dayflagsplus
+                uv[nrows[i] : nrows[i + 1]] = uvplus
+                antenna1[nrows[i] : nrows[i + 1]] = antenna1plus
+                antenna2[nrows[i] : nrows[i + 1]] = antenna2plus
 
         logger.info("gridding visibilities (vector sum) and then building")
         logger.info("scalar average of amplitudes along velocity axis.")
@@ -777,9 +1021,11 @@ class Sunblocker:
         #        data[uvflags,:] = np.nan
 
         logger.info(
-            "approximate minimum u is {0:.0f} and \nthe maximum u is {1:.0f}\napproximate minimum v is {2:.0f} and \nthe maximum v is {3:.0f}".format(
-                umin, umax, vmin, vmax
-            )
+            "approximate minimum u is %.0f and \nthe maximum u is %.0f\napproximate minimum v is %.0f and \nthe maximum v is %.0f",
+            umin,
+            umax,
+            vmin,
+            vmax,
         )
         umin, umax = np.floor(umin), np.ceil(
             umax
@@ -800,19 +1046,15 @@ class Sunblocker:
 
         # Griddedvis are for the viewgraph
         if show != None:
-            griddedvis = np.zeros((ugrid.size, vgrid.size), dtype=float)
+            griddedvis = np.zeros((ugrid.size, vgrid.size), dtype=np.float32)
 
         # For the sake of efficiency create an array that replaces data
         #        nmdata = np.ones(data[:,0].size, dtype = float)
 
-        nmdata = np.zeros(data[:, 0].size, dtype=float)
+        nmdata = np.zeros(data[:, 0].size, dtype=np.float32)
 
-        # Keeping track of central uv coordinates, required for histogram later on
-        gruvcoord = (
-            np.append(np.copy(nmdata), np.copy(nmdata))
-            .reshape((2, nmdata.shape[0]))
-            .transpose()
-        )
+        # Keeping track of integer grid indices, required for histogram later on, -1 for visibilities outside the grid
+        gruvcoord = np.full((nmdata.shape[0], 2), -1, dtype=np.int32)
         # Caution!!! The following would not create an independent copy but is equivalent to grucoord = nmdata. This also works for sub-arrays.
         # grucoord = nmdata[:]
 
@@ -822,59 +1064,57 @@ class Sunblocker:
         # print np.any(testdata)
         ###
 
-        ### The following line belongs to test 3: plot gridded visibs
-        k = 0
-        ###
-
-        collaflags = np.all(flags, axis=1)
-        for uu in tqdm(ugrid, desc="Looping over u"):
-            for vv in tqdm(vgrid, desc="Looping over v", leave=False):
-                #                active_visibs = (u > uu)*(u <= (uu+duv))*(v > vv)*(v <= (vv+duv))
-                if uvmax == None:
-                    active_visibs = (
-                        (u > uu)
-                        * (u <= (uu + duv))
-                        * (v > vv)
-                        * (v <= (vv + duv))
-                        * (u * u + v * v > uvmin * uvmin)
-                    )
-                else:
-                    active_visibs = (
-                        (u > uu)
-                        * (u <= (uu + duv))
-                        * (v > vv)
-                        * (v <= (vv + duv))
-                        * (u * u + v * v < uvmax * uvmax)
-                        * (u * u + v * v > uvmin * uvmin)
-                    )
-
-                active_visibs[collaflags] = False
-                if np.any(active_visibs):
-                    # gruvcoord[active_visibs,:] = uu, vv # Central pixel coordinate
-                    # Central pixel becomes important when doing wedges
-                    gruvcoord[active_visibs, :] = (
-                        uu + duv / 2.0,
-                        vv + duv / 2.0,
-                    )  # Central pixel coordinate
-
-                    ### The following line belongs to test 1
-                    # testdata[active_visibs] = True
-                    ###
-                    scav = np.nanmean(
-                        np.abs(np.nansum(data[active_visibs], axis=0))
-                    )  # Scalar average of amplitude of vectorial sum of visibilities in cell
-                    nmdata[
-                        active_visibs
-                    ] = scav  # set all visibilities in that cell to same cell value
-                    ### The following 4 lines belong to test 3: plot gridded visibs
-                    # if k > 100:
-                    #    print 'Please find and confirm pixel coordinates and values in the greyscale plot: u: %f v: %f value: %f' % (uu+duv/2, vv+duv/2, scav)
-                    #    k = 0
-                    # k = k+1
-                    ###
+        # Rows with all channels flagged, counting is faster than a strided np.all
+        collaflags = np.count_nonzero(flags, axis=1) == flags.shape[1]
+
+        # Only rows with at least one unflagged channel take part in the gridding, select them once
+        keep = np.flatnonzero(np.logical_not(collaflags))
+        ukeep = u[keep]
+        vkeep = v[keep]
+
+        # Find the grid cell of each visibility, cell (iu, iv) covers (uu, uu+duv] x (vv, vv+duv]
+        # The grid is uniform, so the index follows from rescaling, no search needed
+        iu = np.ceil((ukeep - umin) / duv).astype(np.intp) - 1
+        iv = np.ceil((vkeep - vmin) / duv).astype(np.intp) - 1
+        radius2 = ukeep * ukeep + vkeep * vkeep
+        active_visibs = (
+            (iu >= 0)
+            & (iu < ugrid.size)
+            & (iv >= 0)
+            & (iv < vgrid.size)
+            & (radius2 > uvmin * uvmin)
+        )
+        if uvmax != None:
+            active_visibs &= radius2 < uvmax * uvmax
+
+        # Sort the active visibilities by cell, such that each cell is a contiguous block of rows
+        active = np.flatnonzero(active_visibs)
+        cellid = iu[active] * vgrid.size + iv[active]
+        order = np.argsort(cellid, kind="stable")
+        active = active[order]
+        rows = keep[active]
+        cellid = cellid[order]
+        # Count the visibilities per cell in one pass and only visit the occupied cells
+        counts = np.bincount(cellid, minlength=ugrid.size * vgrid.size)
+        cells = np.flatnonzero(counts)
+        counts = counts[cells]
+        starts = np.cumsum(counts) - counts
+        gruvcoord[rows, 0] = iu[active]  # Grid cell indices
+        gruvcoord[rows, 1] = iv[active]
+
+        # Sum the rows of each cell in one pass over the sorted data, nans count as zero like in nansum
+        # The nan mask is evaluated once here, no nans are left for the average along frequency
+        sorteddata = data[rows]
+        sorteddata[np.isnan(sorteddata)] = 0.0
+        scav = np.abs(np.add.reduceat(sorteddata, starts, axis=0)).mean(
+            axis=1
+        )  # Scalar average of amplitude of vectorial sum of visibilities in cell
+        nmdata[rows] = np.repeat(
+            scav, counts
+        )  # set all visibilities in that cell to same cell value
 
-                    if show != None:
-                        griddedvis[ugrid == uu, vgrid == vv] = scav  # For plotting
+        if show != None:
+            griddedvis.flat[cells] = scav  # For plotting, cells are flat indices
 
         # This is the scalar average in frequency
         data = nmdata
@@ -949,20 +1189,29 @@ class Sunblocker:
                 logger.info("Phazer, mode 'antenna', filtering data per antenna.")
                 if show != None:
                     nplotsx = int(np.ceil(np.sqrt(antennas.size)))
-                    i = 0
+                i = 0
+                title = ""
+
+                # Group the rows by antenna once, each row is listed under both of its antennas
+                antcol = np.concatenate((antenna1, antenna2))
+                antorder = np.argsort(antcol, kind="stable")
+                antrows = np.tile(np.arange(antenna1.size), 2)[antorder]
+                antbounds = np.searchsorted(
+                    antcol[antorder], np.append(antennas, antennas[-1] + 1)
+                )
+                scratch = {}
+                # One row mask (data are one-dimensional here) is shared by all antennas, only the rows of the current antenna are unmasked
+                passedflags = np.ones(data.shape, dtype=bool)
                 for antenna in antennas:
                     logger.info(
-                        "filtering antenna {0:d}: {1:s}".format(
-                            antenna, t.ANTENNA.getcol("NAME")[antenna]
-                        )
+                        "filtering antenna %d: %s", antenna, antennanames[antenna]
                     )
-                    passedflags = np.zeros(data.shape, dtype=bool)
-                    select = antenna1 != antenna
-                    select &= antenna2 != antenna
-                    passedflags[select, :] |= True
+                    # Mask all rows (one dimension, like data) that do not contain this antenna
+                    antennarows = antrows[antbounds[i] : antbounds[i + 1]]
+                    passedflags[antennarows] = False
                     if show != None:
                         title = "Ant " + antennanames[antenna]
-                        ax = plt.subplot(nplotsx, nplotsx, i)
+                        ax = plt.subplot(nplotsx, nplotsx, i + 1)
                     else:
                         ax = None
                     newflags |= self.histoclip(
@@ -974,52 +1223,64 @@ class Sunblocker:
                         threshold=threshold,
                         ax=ax,
                         title=title,
+                        scratch=scratch,
                     )
+                    passedflags[antennarows] = True
                     i = i + 1
             else:
-                logger.info("mode 'baseline', filtering data per antenna.")
-                antennas1 = np.unique(antenna1)
-                antennas2 = np.unique(antenna2)
-                pairs = np.unique(np.column_stack((antenna1, antenna2)))
+                logger.info("mode 'baseline', filtering data per baseline.")
+
+                # Pack both antennas of a row into one key and group the rows by baseline once
+                key = antenna1.astype(np.int64) << 32 | antenna2.astype(np.int64)
+                order = np.argsort(key, kind="stable")
+                keys, starts, counts = np.unique(
+                    key[order], return_index=True, return_counts=True
+                )
+                pairs = np.column_stack((keys >> 32, keys & 0xFFFFFFFF))
+                crosses = pairs[:, 0] != pairs[:, 1]
+
                 # Let's guess this
                 if show != None:
-                    nplotsx = int(np.ceil(np.sqrt(pairs.size)))
-                    i = 0
-                for pair in pairs:
-                    if pair[0] != pair[1]:
-                        logger.info(
-                            "Filtering baseline between antenna {0:d}: {1:s} and {2:d}: {3:s}".format(
-                                pair[0],
-                                antennanames[pair[0]],
-                                pair[1],
-                                antennanames[pair[1]],
-                            )
-                        )
-                        passedflags = np.zeros(data.shape, dtype=bool)
-                        select = antenna1 != pair[0]
-                        select &= antenna2 != pair[1]
-                        passedflags[select, :] |= True
-                        if show != None:
-                            title = (
-                                "Pair "
-                                + antennanames[pair[0]]
-                                + ","
-                                + antennanames[pair[1]]
-                            )
-                            ax = plt.subplot(nplotsx, nplotsy, i)
-                        else:
-                            ax = None
-                        newflags |= self.histoclip(
-                            data,
-                            passedflags,
-                            grucoord,
-                            grvcoord,
-                            unflags=unflags,
-                            threshmode=threshmode,
-                            threshold=threshold,
-                            ax=ax,
-                            title=title,
+                    nplotsx = int(np.ceil(np.sqrt(np.count_nonzero(crosses))))
+                i = 0
+                title = ""
+                scratch = {}
+                passedflags = np.ones(data.shape, dtype=bool)
+                for pair, start, count in zip(
+                    pairs[crosses], starts[crosses], counts[crosses]
+                ):
+                    logger.info(
+                        "Filtering baseline between antenna %d: %s and %d: %s",
+                        pair[0],
+                        antennanames[pair[0]],
+                        pair[1],
+                        antennanames[pair[1]],
+                    )
+                    # Mask all rows that do not belong to this baseline
+                    baselinerows = order[start : start + count]
+                    passedflags[baselinerows] = False
+                    if show != None:
+                        title = (
+                            "Pair "
+                            + antennanames[pair[0]]
+                            + ","
+                            + antennanames[pair[1]]
                         )
+                        ax = plt.subplot(nplotsx, nplotsx, i + 1)
+                    else:
+                        ax = None
+                    newflags |= self.histoclip(
+                        data,
+                        passedflags,
+                        gruvcoord,
+                        unflags=unflags,
+                        threshmode=threshmode,
+                        threshold=threshold,
+                        ax=ax,
+                        title=title,
+                        scratch=scratch,
+                    )
+                    passedflags[baselinerows] = True
                     i = i + 1
         if show != None:
             if isinstance(show, str):
@@ -1037,24 +1298,21 @@ class Sunblocker:
         # Extend the new flags, first make a copy of the flags
         if radrange > 0.0 and angle > 0.0:
             logger.info(
-                "extending flags to nearby pixels in the uv-plane using radrange: {0:.0f} and angle: {1:.0f}".format(
-                    radrange, angle
-                )
+                "extending flags to nearby pixels in the uv-plane using radrange: %.0f and angle: %.0f",
+                radrange,
+                angle,
             )
-            flaggeduv = uv[np.column_stack((newflags, newflags))]
-            flaggeduv = flaggeduv.reshape(flaggeduv.size // 2, 2)
-            befflaggeduv = flaggeduv.copy()
-
-            logger.info("processing {:d} points.".format(flaggeduv.size // 2))
-            for i in range(flaggeduv.size // 2):
-                if i % 500 == 0:
-                    logger.info("extended {:d} points.".format(i))
-                thepath = self.wedge_around_centre(flaggeduv[i, :], radrange, angle)
-                if flagonlyday:
-                    newflags[self.selwith_path(thepath, uv) * unflags] = True
-                else:
-                    newflags[self.selwith_path(thepath, uv)] = True
-                if show != None:
+            flaggeduv = uv[newflags]
+            befflaggeduv = flaggeduv
+
+            logger.info("processing %d points.", flaggeduv.shape[0])
+            inwedges = self.selwith_wedges(flaggeduv, uv, radrange, angle)
+            if flagonlyday:
+                inwedges &= unflags
+            newflags |= inwedges
+            if show != None:
+                for i in range(flaggeduv.shape[0]):
+                    thepath = self.wedge_around_centre(flaggeduv[i, :], radrange, angle)
                     patches.append(
                         PathPatch(thepath, facecolor="orange", lw=0, alpha=0.1)
                     )
@@ -1086,8 +1344,7 @@ class Sunblocker:
             ax.set_ylabel("v / $\lambda$")
             for patch in patches:
                 ax.add_patch(patch)
-            flaggeduv = uv[np.column_stack((newflags, newflags))]
-            flaggeduv = flaggeduv.reshape(flaggeduv.size // 2, 2)
+            flaggeduv = uv[newflags]
             #            print uv[:,0].shape
             #            print newflags.shape
             selc = (
@@ -1097,8 +1354,7 @@ class Sunblocker:
                 * (uv[:, 0] >= umin)
                 * (uv[:, 1] >= vmin)
             )
-            notflaggeduv = uv[np.column_stack((selc, selc))]
-            notflaggeduv = notflaggeduv.reshape(notflaggeduv.size // 2, 2)
+            notflaggeduv = uv[selc]
             # Restrict uvrange to maximum of uvmax and befflaggeduv
             ####
 
@@ -1130,6 +1386,29 @@ class Sunblocker:
                 plt.show()
                 plt.close()
 
+        self.writeflags(
+            inset,
+            outset,
+            [newflags[nrows[i] : nrows[i + 1]] for i in range(len(inset))],
+            dryrun=dryrun,
+        )
+        logger.info("exiting (successfully).")
+        return
+
+    def writeflags(self, inset, outset, rowflags, dryrun=True):
+        """
+        Apply row flags to a number of data sets, copying input to output data sets where required
+
+        Input:
+        inset (list of str)       : Input data sets
+        outset (list of str)      : Output data sets, same length as inset, or None to flag inset itself
+        rowflags (list of arrays) : Boolean arrays, one per data set with one entry per row, True for rows to flag
+        dryrun (bool)             : Do not apply flags, only log what would be done
+
+        Each output data set is opened (or copied from the
+        corresponding input data set if it does not exist), flagged
+        with flagrows and closed again, one after the other.
+        """
         if isinstance(outset, str):
             outset = [outset]
 
@@ -1143,16 +1422,16 @@ class Sunblocker:
 
         for i in range(len(outset)):
             if tables.tableexists(outset[i]):
-                logger.info("opening data set {:s}".format(outset[i]))
+                logger.info("opening data set %s", outset[i])
                 if not dryrun:
                     tout = self.opensilent(outset[i], readonly=False)
                 else:
                     logger.info("it's a simulation (dry run)")
             else:
                 logger.info(
-                    "data set {0:s} does not exist. Copying it from data set {1:s}".format(
-                        outset[i], inset[i]
-                    )
+                    "data set %s does not exist. Copying it from data set %s",
+                    outset[i],
+                    inset[i],
                 )
                 if not dryrun:
                     t = self.opensilent(inset[i])
@@ -1164,21 +1443,12 @@ class Sunblocker:
                     logger.info("it's a simulation (dry run)")
 
             # Now apply newflags to the data
-            logger.info("applying new flags.")
+            logger.info("applying new flags.\nwriting flags.")
             if not dryrun:
-                flags = tout.getcol("FLAG")
-                flags[newflags[nrows[i] : nrows[i + 1]], :, :] = True
-            else:
-                logger.info("it's a simulation (dry run)")
-
-            logger.info("writing flags.")
-            if not dryrun:
-                tout.putcol("FLAG", flags)
+                self.flagrows(tout, rowflags[i])
                 tout.close()
             else:
                 logger.info("it's a simulation (dry run).")
-        logger.info("exiting (successfully).")
-        return
 
     def astropy_to_pyephemtime(self, astropytime):
         return astropytime.mjd - 15019.5
@@ -1236,51 +1506,49 @@ class Sunblocker:
 
         logger.info("start.")
 
+        # The settings are reported in a single log record
+        settings = []
+        settingsargs = []
         if dryrun:
-            logger.info("this is a dry run. Flags will not be applied.")
+            settings.append("this is a dry run. Flags will not be applied.")
             drypre = "Because of dry run not"
         else:
             drypre = ""
         if avantsoleil != 0.0:
-            logger.info(
-                "{0:s} flagging starts {1:s} before sunrise.".format(
-                    drypre, avantsoleil
-                )
-            )
+            settings.append("%s flagging starts %s before sunrise.")
+            settingsargs += [drypre, avantsoleil]
         else:
-            logger.info("{0:s} flagging starts at sunrise".format(drypre))
+            settings.append("%s flagging starts at sunrise")
+            settingsargs.append(drypre)
         if not nononsoleil:
             if apresnuit != 0.0:
-                logger.info(
-                    "{0:s} flagging ends {1:s} after sunrise.".format(drypre, apresnuit)
-                )
+                settings.append("%s flagging ends %s after sunrise.")
+                settingsargs += [drypre, apresnuit]
             else:
-                logger.info("{:s} flagging ends at sunrise".format(drypre))
+                settings.append("%s flagging ends at sunrise")
+                settingsargs.append(drypre)
             if avantnuit != 0.0:
-                logger.info(
-                    "{0:s} flagging starts {1:s} before sunset.".format(
-                        drypre, avantnuit
-                    )
-                )
+                settings.append("%s flagging starts %s before sunset.")
+                settingsargs += [drypre, avantnuit]
         if apresoleil != 0.0:
-            logger.info(
-                "{0:s} flagging ends {1:s} after sunset.".format(drypre, apresoleil)
-            )
+            settings.append("%s flagging ends %s after sunset.")
+            settingsargs += [drypre, apresoleil]
         else:
-            logger.info("{0:s} flagging ends at sunset".format(drypre))
+            settings.append("%s flagging ends at sunset")
+            settingsargs.append(drypre)
 
         if horizon != 0.0:
-            logger.info(
-                "we think that the sun has really set (oh how I hate it!) when its centre is {:s} below the horizon".format(
-                    -horizon
-                )
+            settings.append(
+                "we think that the sun has really set (oh how I hate it!) when its centre is %s below the horizon"
             )
+            settingsargs.append(-horizon)
+        logger.info("\n".join(settings), *settingsargs)
 
         # We really don't want to hear about this
         if isinstance(inset, str):
-            logger.info("opening visibility file {:s}.".format(inset))
+            logger.info("opening visibility file %s.", inset)
         else:
-            logger.info("opening visibility file {:s}.".format(inset.name()))
+            logger.info("opening visibility file %s.", inset.name())
 
         # This is either a string or a data set, it will return the right thing
         if dryrun:
@@ -1309,27 +1577,31 @@ class Sunblocker:
         telpos = coordinates.EarthLocation(lon=lone, lat=late, height=heie)
 
         logger.info(
-            "It appears that the observatory latitude is {0:s}, the longitude {1:s}, and the height {2:s}".format(
-                telpos.geodetic.lon, telpos.geodetic.lat, telpos.geodetic.height
-            )
+            "It appears that the observatory latitude is %s, the longitude %s, and the height %s",
+            telpos.geodetic.lon,
+            telpos.geodetic.lat,
+            telpos.geodetic.height,
         )
 
         # Read time stamps
         logger.info("reading time stamps.")
         dd = t.getcol("TIME") / (24.0 * 3600.0)
-        times = time.Time(dd, format="mjd", scale="utc")
-        mindd = np.amin(dd) - t.getcol("INTERVAL")[0] / (2.0 * 24.0 * 3600.0)
+        mindd = np.amin(dd) - t.getcell("INTERVAL", 0) / (2.0 * 24.0 * 3600.0)
         obstart = time.Time(mindd, format="mjd", scale="utc")
         # obstart = np.amin(times)
         eobstart = ephem.Date(self.astropy_to_pyephemtime(obstart))
-        maxdd = np.amax(dd) + t.getcol("INTERVAL")[-1] / (2.0 * 24.0 * 3600.0)
+        maxdd = np.amax(dd) + t.getcell("INTERVAL", t.nrows() - 1) / (
+            2.0 * 24.0 * 3600.0
+        )
         obsend = time.Time(maxdd, format="mjd", scale="utc")
         # obsend = np.amax(times)
         eobsend = ephem.Date(self.astropy_to_pyephemtime(obsend))
-        logger.info("the observation started at {:s} (UTC)".format(obstart.iso))
-        logger.info("the observation ended at {:s} (UTC)".format(obsend.iso))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("the observation started at %s (UTC)", obstart.iso)
+            logger.info("the observation ended at %s (UTC)", obsend.iso)
 
-        etimes = self.astropy_to_pyephemtime(times)
+        # Only the pyephem dates of the time stamps are needed, which follow from the mjd without building an astropy Time per row
+        etimes = dd - 15019.5
 
         # Pyephem stuff
         etel = ephem.Observer()
@@ -1361,13 +1633,14 @@ class Sunblocker:
             esti = etel.next_rising(esun)
             if esti < eobsend:
                 ncross += 1
-                logger.info(
-                    "the sun (yuck!) rose at {:s} (UTC)".format(
-                        esti.datetime().strftime("%Y-%m-%d, %H:%M:%S")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "the sun (yuck!) rose at %s (UTC)",
+                        esti.datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                     )
-                )
 
-        flags = np.zeros(dd.size, dtype=bool)
+        # Times to flag are collected as brackets (start, end) and applied after the loop
+        brackets = []
 
         while (esti - float(avantsoleil.to(units.d).value)) < eobsend:
             etel.date = esti
@@ -1375,11 +1648,11 @@ class Sunblocker:
 
             if eeti < eobsend:
                 ncross += 1
-                logger.info(
-                    "the sun (hrgh!) set at {:s} (UTC), time to rise, Ha! HA, HAHA!".format(
-                        eeti.datetime().strftime("%Y-%m-%d, %H:%M:%S")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "the sun (hrgh!) set at %s (UTC), time to rise, Ha! HA, HAHA!",
+                        eeti.datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                     )
-                )
 
             if nononsoleil:
                 # Only one bracket, add times
@@ -1387,14 +1660,14 @@ class Sunblocker:
                 eetiapp = float(eeti) + float(apresoleil.to(units.d).value)
                 estihad = max(estiapp, eobstart)
                 eetihad = min(eetiapp, eobsend)
-                logger.info(
-                    "{0:s} flagging between {1:s} (UTC) and {2:s} (UTC).".format(
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "%s flagging between %s (UTC) and %s (UTC).",
                         drypre,
                         ephem.Date(estihad).datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                         ephem.Date(eetihad).datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                     )
-                )
-                flags = flags + (etimes >= float(estiapp)) * (float(eetiapp) >= etimes)
+                brackets.append((estiapp, eetiapp))
             else:
                 # Two brackets, add times
                 estiapp = float(esti) - float(avantsoleil.to(units.d).value)
@@ -1403,16 +1676,16 @@ class Sunblocker:
                 eetiapp2 = float(eeti) + float(apresoleil.to(units.d).value)
                 estihad = max(estiapp, eobstart)
                 eetihad = min(eetiapp2, eobsend)
-                logger.info(
-                    "{0:s} flagging between {1:s} (UTC) and {2:s} (UTC) and".format(
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "%s flagging between %s (UTC) and %s (UTC) and",
                         drypre,
                         ephem.Date(estihad).datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                         ephem.Date(eetiapp).datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                     )
-                )
-                if estiapp2 < eobsend:
-                    logger.info(
-                        "{0:s} flagging between {1:s} (UTC) and {2:s} (UTC).".format(
+                    if estiapp2 < eobsend:
+                        logger.info(
+                            "%s flagging between %s (UTC) and %s (UTC).",
                             drypre,
                             ephem.Date(estiapp2)
                             .datetime()
@@ -1421,29 +1694,35 @@ class Sunblocker:
                             .datetime()
                             .strftime("%Y-%m-%d, %H:%M:%S"),
                         )
-                    )
-                flags = flags + (etimes >= float(estiapp)) * (float(eetiapp) >= etimes)
-                flags = flags + (etimes >= float(estiapp2)) * (
-                    float(eetiapp2) >= etimes
-                )
+                brackets.append((estiapp, eetiapp))
+                brackets.append((estiapp2, eetiapp2))
 
             # Get next sunrise by setting the current time to the current sunset and requesting next sunrise
             etel.date = eeti
             esti = etel.next_rising(esun)
             if esti < eobsend:
                 ncross += 1
-                logger.info(
-                    "the sun (aargh!) rose at {:s}".format(
-                        esti.datetime().strftime("%Y-%m-%d, %H:%M:%S")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "the sun (aargh!) rose at %s",
+                        esti.datetime().strftime("%Y-%m-%d, %H:%M:%S"),
                     )
-                )
+
+        # A time is inside as many brackets as have started at or before it minus the ones that ended before it
+        starts, ends = np.sort(np.array(brackets).reshape(-1, 2), axis=0).T
+        inside = np.searchsorted(starts, etimes, side="right")
+        inside -= np.searchsorted(ends, etimes, side="left")
+
+        # Inverted flags (see below) are the times outside all brackets, which is decided in the same pass
+        if flinvert:
+            flags = inside <= 0
+        else:
+            flags = inside > 0
 
         addendum = ""
         if ncross > 1:
             logger.info(
-                "the sun crossed the horizon {:d} times during the observation".format(
-                    ncross
-                )
+                "the sun crossed the horizon %d times during the observation", ncross
             )
         else:
             if ncross > 0:
@@ -1458,41 +1737,86 @@ class Sunblocker:
 
         if esti > eeti:
             logger.info(
-                "at the end of the observation the sun (Uuuh!) was {:s} up.".format(
-                    addendum
-                )
+                "at the end of the observation the sun (Uuuh!) was %s up.", addendum
             )
         else:
             logger.info(
-                "at the end of the observation it was {:s} a beautiful night.".format(
-                    addendum
-                )
+                "at the end of the observation it was %s a beautiful night.", addendum
             )
 
-        # Invert flags
+        # Flags have been inverted when they were set
         if flinvert:
             logger.info(
-                "inverting flags, that means {:s} flag everything in the night (terrible)!".format(
-                    drypre
-                )
+                "inverting flags, that means %s flag everything in the night (terrible)!",
+                drypre,
             )
-            flags = np.logical_not(flags)
 
         # Now apply flags
-        logger.info("{:s} applying flags to data.".format(drypre))
+        logger.info("%s applying flags to data.", drypre)
         if not dryrun:
-            oflags = t.getcol("FLAG")
-            oflags[flags, :, :] = True
-            t.putcol("FLAG", oflags)
+            self.flagrows(t, flags)
 
         logger.info("finis.")
 
-        if isinstance(t, str):
+        # Close only if the data set has been opened here, i.e. inset has been a string
+        if isinstance(inset, str):
             t.close()
 
         return flags
 
 
+def _readshared(inset, readargs):
+    """Read a data set in a worker process and hand back data and flags in shared memory
+
+    Input:
+    inset (str)   : Input data set
+    readargs (dict): Keyword arguments passed on to Sunblocker.readdata
+
+    Output:
+    shared (list), uv, antenna1, antenna2, antennanames: shared is a
+    list of (segment name, shape, dtype) for data and flags, the rest
+    as returned by Sunblocker.readdata
+
+    Only the segment names are sent back to the parent process, which
+    avoids pickling the large data and flag arrays.
+    """
+    data, flags, uv, antenna1, antenna2, antennanames = Sunblocker().readdata(
+        inset, **readargs
+    )
+    shared = []
+    for array in (data, flags):
+        segment = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            shared.append((segment.name, array.shape, array.dtype.str))
+        except BaseException:
+            segment.unlink()
+            raise
+        finally:
+            segment.close()
+    return shared, uv, antenna1, antenna2, antennanames
+
+
+def _fromshared(shared):
+    """Copy arrays out of shared memory segments and release the segments
+
+    Input:
+    shared (list): (segment name, shape, dtype) as returned by _readshared
+
+    Output:
+    arrays (list): Private copies of the arrays
+    """
+    arrays = []
+    for name, shape, dtype in shared:
+        segment = shared_memory.SharedMemory(name=name)
+        try:
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=segment.buf).copy())
+        finally:
+            segment.close()
+            segment.unlink()
+    return arrays
+
+
 # if __name__ == "__main__":
 #     a = np.zeros((767), dtype=bool)
 #     a[1:35] = True
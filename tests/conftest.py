@@ -0,0 +1,73 @@
+import numpy as np
+import pyrap.tables as tables
+import pytest
+
+
+@pytest.fixture
+def make_ms(tmp_path):
+    """Factory for small synthetic data sets in tmp_path
+
+    Every baseline including autocorrelations is observed at ntime time
+    stamps, 10 min apart, with two polarisations. Visibilities on short
+    baselines get an offset, such that there is something to flag, and 5%
+    of the flags are set at random. Field ids cycle through nfield per time
+    stamp.
+    """
+
+    def make(name, nant=7, ntime=40, nchan=16, nfield=1, seed=0):
+        path = str(tmp_path / name)
+        rng = np.random.default_rng(seed)
+        antenna1, antenna2 = np.triu_indices(nant)
+        nbl = antenna1.size
+        nrow = nbl * ntime
+        antenna1, antenna2 = np.tile(antenna1, ntime), np.tile(antenna2, ntime)
+
+        # Rotate the baselines with the hour angle to fill the uv-plane
+        pos = rng.normal(size=(nant, 3)) * 300.0
+        ha = np.repeat(np.linspace(-1.0, 1.0, ntime), nbl)
+        d = pos[antenna1] - pos[antenna2]
+        uvw = np.stack(
+            (
+                d[:, 0] * np.cos(ha) - d[:, 1] * np.sin(ha),
+                d[:, 0] * np.sin(ha) + d[:, 1] * np.cos(ha),
+                d[:, 2],
+            ),
+            axis=1,
+        )
+        data = rng.normal(size=(nrow, nchan, 2)) + 1j * rng.normal(
+            size=(nrow, nchan, 2)
+        )
+        data[np.hypot(uvw[:, 0], uvw[:, 1]) < 250.0] += 8.0
+
+        t = tables.default_ms(
+            path,
+            tables.maketabdesc(
+                tables.makearrcoldesc(
+                    "DATA", 0j, valuetype="complex", ndim=2, shape=[nchan, 2]
+                )
+            ),
+        )
+        t.addrows(nrow)
+        t.putcol("ANTENNA1", antenna1)
+        t.putcol("ANTENNA2", antenna2)
+        t.putcol("TIME", np.repeat(4.9e9 + np.arange(ntime) * 600.0, nbl))
+        t.putcol("INTERVAL", np.full(nrow, 600.0))
+        t.putcol("FIELD_ID", np.repeat(np.arange(ntime) % nfield, nbl))
+        t.putcol("UVW", uvw)
+        t.putcol("DATA", data.astype(np.complex64))
+        t.putcol("FLAG", rng.random((nrow, nchan, 2)) < 0.05)
+        t.close()
+
+        t = tables.table(path + "/SPECTRAL_WINDOW", readonly=False, ack=False)
+        t.addrows(1)
+        t.putcell("CHAN_FREQ", 0, np.linspace(1.4e9, 1.42e9, nchan))
+        t.putcell("NUM_CHAN", 0, nchan)
+        t.close()
+        t = tables.table(path + "/ANTENNA", readonly=False, ack=False)
+        t.addrows(nant)
+        t.putcol("NAME", np.array([f"A{i}" for i in range(nant)]))
+        t.putcol("POSITION", np.array([5109224.0, 2006790.0, -3239100.0]) + pos)
+        t.close()
+        return path
+
+    return make
@@ -0,0 +1,79 @@
+import numpy as np
+import pyrap.tables as tables
+import pytest
+
+from sunblocker.sunblocker import Sunblocker
+
+# Row counts around and between multiples of the 8 rows in a 64-bit word and of 64
+NROWS = (1, 3, 7, 8, 9, 63, 64, 65, 130)
+
+
+def rowmasks(nrows, seed=0):
+    """All-False, all-True, single and random row masks of length nrows"""
+    rng = np.random.default_rng(seed)
+    masks = [np.zeros(nrows, dtype=bool), np.ones(nrows, dtype=bool)]
+    for row in {0, nrows // 2, nrows - 1}:
+        masks.append(np.zeros(nrows, dtype=bool))
+        masks[-1][row] = True
+    masks.append(rng.random(nrows) < 0.5)
+    masks.append(~masks[-1])
+    return masks
+
+
+def naive_runs(mask):
+    """Runs of True values, found one element at a time"""
+    starts, lengths = [], []
+    for i, value in enumerate(mask):
+        if value and (i == 0 or not mask[i - 1]):
+            starts.append(i)
+            lengths.append(0)
+        if value:
+            lengths[-1] += 1
+    return starts, lengths
+
+
+@pytest.mark.parametrize("nrows", NROWS + (127, 128, 1000))
+def test_truruns(nrows):
+    for mask in rowmasks(nrows):
+        # An offset view checks that the mask need not be aligned
+        for view in (mask, np.concatenate(([True], mask))[1:]):
+            starts, lengths = Sunblocker().truruns(view)
+            assert (list(starts), list(lengths)) == naive_runs(mask)
+
+
+@pytest.mark.parametrize("blocksize", (1, 64, 67108864))
+@pytest.mark.parametrize("nrows", NROWS)
+def test_flagrows(make_ms, nrows, blocksize):
+    # One antenna observing nrows times gives one row per time stamp
+    path = make_ms("flagrows.ms", nant=1, ntime=nrows, nchan=4)
+    t = tables.table(path, ack=False)
+    original = t.getcol("FLAG")
+    t.close()
+
+    # The same instance is used for all masks, so its cached block of flags is reused
+    blocker = Sunblocker()
+    for rowflags in rowmasks(nrows):
+        t = tables.table(path, readonly=False, ack=False)
+        t.putcol("FLAG", original)
+        blocker.flagrows(t, rowflags, blocksize=blocksize)
+        flags = t.getcol("FLAG")
+        t.close()
+        for row in range(nrows):
+            if rowflags[row]:
+                assert flags[row].all()
+            else:
+                assert np.array_equal(flags[row], original[row])
+
+
+def test_flagrows_cached_block_follows_cell_shape(make_ms):
+    blocker = Sunblocker()
+    for nchan in (4, 8, 2):
+        path = make_ms(f"flagrows{nchan}.ms", nant=1, ntime=9, nchan=nchan)
+        rowflags = np.arange(9) % 3 == 0
+        t = tables.table(path, readonly=False, ack=False)
+        original = t.getcol("FLAG")
+        blocker.flagrows(t, rowflags)
+        flags = t.getcol("FLAG")
+        t.close()
+        assert flags[rowflags].all()
+        assert np.array_equal(flags[~rowflags], original[~rowflags])
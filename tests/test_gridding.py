@@ -0,0 +1,112 @@
+import numpy as np
+import pyrap.tables as tables
+import pytest
+
+from sunblocker.sunblocker import Sunblocker
+
+
+def baseline_grid(data, flags, uv, imsize, cell, uvmin=0.0, uvmax=None):
+    """Gridding as done originally: a loop over all cells, each selecting its visibilities"""
+    duv = 1.0 / (imsize * cell * np.pi / (3600.0 * 180.0))
+    u, v = uv[:, 0], uv[:, 1]
+    umin, umax, vmin, vmax = u.min(), u.max(), v.min(), v.max()
+    if uvmax is not None:
+        umin, umax, vmin, vmax = -uvmax, uvmax, -uvmax, uvmax
+    ugrid = np.arange(np.floor(umin), np.ceil(umax), duv)
+    vgrid = np.arange(np.floor(vmin), np.ceil(vmax), duv)
+
+    nmdata = np.zeros(u.size)
+    gruvcoord = np.zeros((u.size, 2))
+    collaflags = np.all(flags, axis=1)
+    for uu in ugrid:
+        for vv in vgrid:
+            active = (
+                (u > uu)
+                & (u <= uu + duv)
+                & (v > vv)
+                & (v <= vv + duv)
+                & (u * u + v * v > uvmin * uvmin)
+            )
+            if uvmax is not None:
+                active &= u * u + v * v < uvmax * uvmax
+            active[collaflags] = False
+            if np.any(active):
+                gruvcoord[active] = uu + duv / 2.0, vv + duv / 2.0
+                nmdata[active] = np.nanmean(np.abs(np.nansum(data[active], axis=0)))
+    return nmdata, gruvcoord
+
+
+def baseline_rowflags(
+    inset,
+    imsize,
+    cell,
+    threshold,
+    uvmin=0.0,
+    uvmax=None,
+    radrange=0.0,
+    angle=0.0,
+    flagonlyday=False,
+):
+    """Row flags of phazer in mode 'all', with the gridding done by baseline_grid"""
+    blocker = Sunblocker()
+    reads = [blocker.readdata(name, pol="i") for name in inset]
+    data = np.concatenate([read[0] for read in reads])
+    flags = np.concatenate([read[1] for read in reads])
+    uv = np.concatenate([read[2] for read in reads])
+    unflags = None
+    if flagonlyday:
+        unflags = np.concatenate(
+            [blocker.vampirisms(name, dryrun=True, flinvert=True) for name in inset]
+        )
+
+    nmdata, gruvcoord = baseline_grid(data, flags, uv, imsize, cell, uvmin, uvmax)
+    newflags = blocker.histoclip(
+        nmdata,
+        np.zeros(nmdata.shape, dtype=bool),
+        gruvcoord,
+        unflags=unflags,
+        threshold=threshold,
+    )
+    if radrange > 0.0 and angle > 0.0:
+        inwedges = blocker.selwith_wedges(uv[newflags], uv, radrange, angle)
+        if flagonlyday:
+            inwedges &= unflags
+        newflags |= inwedges
+    return np.split(newflags, np.cumsum([read[0].shape[0] for read in reads])[:-1])
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    (
+        {},
+        {"radrange": 100.0, "angle": 10.0},
+        {"uvmin": 200.0},
+        {"uvmin": 50.0, "uvmax": 1000.0},
+        {"flagonlyday": True},
+    ),
+)
+@pytest.mark.parametrize("ninset", (1, 2))
+def test_flags_match_baseline_gridding(make_ms, tmp_path, kwargs, ninset):
+    inset = [make_ms(f"in{i}.ms", seed=i, ntime=40 - 10 * i) for i in range(ninset)]
+    outset = [str(tmp_path / f"out{i}.ms") for i in range(ninset)]
+    Sunblocker().phazer(
+        inset,
+        outset=outset,
+        imsize=64,
+        cell=60,
+        threshold=3.0,
+        pol="i",
+        dryrun=False,
+        **kwargs,
+    )
+
+    expected = baseline_rowflags(inset, 64, 60, 3.0, **kwargs)
+    assert any(rowflags.any() for rowflags in expected)
+    for name, outname, rowflags in zip(inset, outset, expected):
+        t = tables.table(name, ack=False)
+        before = t.getcol("FLAG")
+        t.close()
+        t = tables.table(outname, ack=False)
+        after = t.getcol("FLAG")
+        t.close()
+        assert np.array_equal(after, before | rowflags[:, np.newaxis, np.newaxis])
@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.optimize as opt
+from astropy.stats import mad_std, sigma_clip
+
+from sunblocker.sunblocker import Sunblocker
+
+
+def gaussian_plus_outliers(seed=42):
+    rng = np.random.default_rng(seed)
+    data = np.concatenate(
+        (
+            rng.normal(10.0, 1.0, 5000),
+            rng.normal(10.0, 1.0, 2000) * 0.5 + 5.0,
+            np.full(50, 30.0),
+        )
+    )
+    # One grid cell per data point
+    gruvcoord = np.column_stack(
+        (np.arange(data.size), np.zeros(data.size, dtype=int))
+    ).astype(np.int32)
+    return data, np.zeros(data.size, dtype=bool), gruvcoord
+
+
+def baseline_fit_flags(data, threshold):
+    """Flags as derived by the original histogram fit: curve_fit started at the histogram maximum"""
+    clipped = sigma_clip(
+        data,
+        sigma=threshold,
+        maxiters=None,
+        stdfunc=mad_std,
+        cenfunc=np.nanmedian,
+        masked=False,
+    )
+    clipped = clipped[np.isfinite(clipped)]
+    hist, bin_edges = np.histogram(clipped, bins=int(np.sqrt(clipped.size)) + 1)
+    bin_centers = bin_edges[:-1] + 0.5 * (bin_edges[1:] - bin_edges[:-1])
+    popt, pcov = opt.curve_fit(
+        Sunblocker().gaussian,
+        bin_centers,
+        hist,
+        p0=[bin_centers[np.argmax(hist)], np.amax(hist), np.std(clipped) / 2.0],
+    )
+    return data >= popt[0] + threshold * popt[2]
+
+
+def test_fit_flags_match_baseline_fit():
+    data, mask, gruvcoord = gaussian_plus_outliers()
+    for threshold in (3.0, 5.0):
+        flags = Sunblocker().histoclip(
+            data, mask, gruvcoord, threshmode="fit", threshold=threshold
+        )
+        expected = baseline_fit_flags(data, threshold)
+        assert np.count_nonzero(flags) == np.count_nonzero(expected)
+        assert np.array_equal(flags, expected)
+
+
+def test_fit_flags_outliers():
+    data, mask, gruvcoord = gaussian_plus_outliers()
+    flags = Sunblocker().histoclip(
+        data, mask, gruvcoord, threshmode="fit", threshold=5.0
+    )
+    assert flags[-50:].all()
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pyrap.tables as tables
+
+from sunblocker.sunblocker import Sunblocker
+
+
+def shared_segments():
+    """Names of POSIX shared memory segments, empty where they cannot be listed"""
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+
+def test_parallel_read_matches_serial_read(make_ms, tmp_path):
+    inset = [make_ms("a.ms", seed=1), make_ms("b.ms", seed=2, ntime=30)]
+    before = shared_segments()
+    flags = {}
+    for nprocs in (1, 2):
+        outset = [str(tmp_path / f"{nprocs}{name}") for name in ("a.ms", "b.ms")]
+        Sunblocker().phazer(
+            inset,
+            outset=outset,
+            imsize=64,
+            cell=60,
+            threshold=3.0,
+            dryrun=False,
+            pol="i",
+            nprocs=nprocs,
+        )
+        flags[nprocs] = []
+        for name in outset:
+            t = tables.table(name, ack=False)
+            flags[nprocs].append(t.getcol("FLAG"))
+            t.close()
+
+    for serial, parallel, name in zip(flags[1], flags[2], inset):
+        t = tables.table(name, ack=False)
+        assert np.any(serial & ~t.getcol("FLAG"))
+        t.close()
+        assert np.array_equal(serial, parallel)
+    assert shared_segments() == before
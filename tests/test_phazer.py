@@ -0,0 +1,115 @@
+import subprocess
+import sys
+
+import pytest
+
+from sunblocker import phazer
+
+ARGVS = (
+    ["in.ms", "out.ms"],
+    ["a.ms", "b.ms", "out.ms", "-r", "4", "-m", "antenna"],
+    ["-r5", "in.ms", "out.ms"],
+    ["-r=5", "-chchan.txt", "in.ms", "out.ms"],
+    ["--thresho", "3", "--threshm=std", "in.ms", "out.ms"],
+    ["--times", "1", "-2", "3", "4", "in.ms", "out.ms"],
+    ["-H", "-30", "-Vyd", "in.ms", "out.ms"],
+    ["-Vr5", "--dry", "in.ms", "out.ms"],
+    ["-r", "3", "--", "-in.ms", "out.ms"],
+)
+
+BAD_ARGVS = (
+    ["in.ms"],
+    ["--thresh", "3", "in.ms", "out.ms"],
+    ["-x", "in.ms", "out.ms"],
+    ["-r", "-V", "in.ms", "out.ms"],
+    ["--dryrun=1", "in.ms", "out.ms"],
+    ["-rfive", "in.ms", "out.ms"],
+    ["--mode", "none", "in.ms", "out.ms"],
+    ["--times", "1", "2", "in.ms"],
+)
+
+
+@pytest.mark.parametrize("argv", ARGVS)
+def test_parse_args_matches_argparse(argv, monkeypatch):
+    expected = vars(phazer._build_parser().parse_args(argv))
+    monkeypatch.setattr("sys.argv", ["phazer"] + argv)
+    assert vars(phazer.parse_args()) == expected
+
+
+@pytest.mark.parametrize("argv", BAD_ARGVS)
+def test_parse_args_rejects_like_argparse(argv, monkeypatch):
+    with pytest.raises(SystemExit) as expected:
+        phazer._build_parser().parse_args(argv)
+    monkeypatch.setattr("sys.argv", ["phazer"] + argv)
+    with pytest.raises(SystemExit) as excinfo:
+        phazer.parse_args()
+    assert excinfo.value.code == expected.value.code == 2
+
+
+def test_parse_args_help(monkeypatch, capsys):
+    monkeypatch.setattr("sys.argv", ["phazer", "--he"])
+    with pytest.raises(SystemExit) as excinfo:
+        phazer.parse_args()
+    assert excinfo.value.code == 0
+    assert capsys.readouterr().out.startswith("usage: phazer")
+
+
+def test_mmap_loadtxt_caches_outside_input_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    path = inputs / "baselines.txt"
+    path.write_text("0 1\n2 3\n")
+    assert phazer._mmap_loadtxt(str(path), dtype=int).tolist() == [[0, 1], [2, 3]]
+    assert phazer._mmap_loadtxt(str(path), dtype=int).tolist() == [[0, 1], [2, 3]]
+    assert [p.name for p in inputs.iterdir()] == ["baselines.txt"]
+    assert len(list((tmp_path / "cache" / "sunblocker").iterdir())) == 1
+
+    # A changed file is not served from the cache
+    path.write_text("4 5\n6 7\n8 9\n")
+    assert phazer._mmap_loadtxt(str(path), dtype=int).tolist() == [
+        [4, 5],
+        [6, 7],
+        [8, 9],
+    ]
+
+
+@pytest.mark.parametrize(
+    "argv", (["--help"], ["--mode", "bogus", "a", "b"], ["-c"], ["in.ms", "out.ms"])
+)
+def test_parse_args_keeps_numpy_and_astropy_unimported(argv):
+    script = (
+        "import sys\n"
+        "from sunblocker import phazer\n"
+        f"sys.argv = ['phazer'] + {argv!r}\n"
+        "try:\n"
+        "    phazer.parse_args()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted({'numpy', 'astropy'} & set(sys.modules)), file=sys.stderr)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    assert result.stderr.splitlines()[-1] == "[]"
+
+
+def test_run_as_module_without_warning():
+    result = subprocess.run(
+        [sys.executable, "-W", "error", "-m", "sunblocker.phazer", "--help"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith("usage: phazer")
+
+
+def test_run_is_exported():
+    import sunblocker
+
+    assert sunblocker.run is phazer.run
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from sunblocker.sunblocker import Sunblocker
+
+SELECTIONS = (
+    {},
+    {"fields": [0, 2]},
+    {"baselines": np.array([[0, 1], [3, 2], [4, 6], [5, 5]])},
+    {"channels": np.arange(16) % 5 != 0},
+    {
+        "fields": 1,
+        "baselines": np.array([[1, 0], [2, 6]]),
+        "channels": np.arange(16) > 3,
+        "pol": "q",
+    },
+)
+
+
+@pytest.mark.parametrize("selection", SELECTIONS)
+def test_chunked_read_matches_single_read(make_ms, selection):
+    # 28 baselines times 11 time stamps are 308 rows, a multiple of none of the chunk sizes below but 1 and 7
+    path = make_ms("chunks.ms", ntime=11, nfield=3)
+    nrows = 308
+    whole = Sunblocker().readdata(path, nrowchunk=nrows, **selection)
+    for nrowchunk in (1, 7, 10, 64, nrows - 1, nrows + 1):
+        chunked = Sunblocker().readdata(path, nrowchunk=nrowchunk, **selection)
+        for expected, actual in zip(whole, chunked):
+            np.testing.assert_array_equal(actual, expected)
+
+
+def test_selections(make_ms):
+    path = make_ms("selections.ms", ntime=11, nfield=3)
+    data, flags, uv, antenna1, antenna2, _ = Sunblocker().readdata(path)
+    field = np.repeat(np.arange(11) % 3, 28)
+    pairs = {(0, 1), (2, 3), (4, 6)}
+    channels = np.arange(16) % 5 != 0
+
+    selected = Sunblocker().readdata(
+        path,
+        fields=[0, 2],
+        baselines=np.array([[0, 1], [3, 2], [4, 6], [5, 5]]),
+        channels=channels,
+        nrowchunk=10,
+    )
+
+    # A row is deselected if it is an autocorrelation, in another field, or on another baseline, in either order
+    rowflags = np.array(
+        [
+            a == b or f == 1 or (min(a, b), max(a, b)) not in pairs
+            for a, b, f in zip(antenna1, antenna2, field)
+        ]
+    )
+    expected = flags | rowflags[:, np.newaxis] | ~channels
+    np.testing.assert_array_equal(selected[1], expected)
+    np.testing.assert_array_equal(selected[0], np.where(expected, np.nan, data))
+    np.testing.assert_array_equal(selected[2], uv)
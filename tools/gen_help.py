@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Render the phazer help text into sunblocker/_help.py
+
+Run this whenever the command line options in sunblocker/phazer.py change.
+"""
+import os
+
+build_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main() -> None:
+    # Fix the terminal width so the output does not depend on who runs this
+    os.environ["COLUMNS"] = "80"
+
+    from sunblocker.phazer import _build_parser
+
+    text = _build_parser().format_help()
+    if '"""' in text or "\\" in text:
+        raise ValueError("help text cannot be stored in a triple-quoted string")
+
+    with open(os.path.join(build_root, "sunblocker", "_help.py"), "w") as f:
+        f.write("# Generated by tools/gen_help.py, do not edit\n")
+        f.write(f'HELP = """{text}"""\n')
+
+
+if __name__ == "__main__":
+    main()